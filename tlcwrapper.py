@@ -7,23 +7,38 @@ import os
 import subprocess
 import argparse
 import signal
+import json
+import csv
+import time
+import hashlib
+import pickle
+import threading
+import sqlite3
 
 from collections import OrderedDict
 from configparser import ConfigParser
 from itertools import chain, zip_longest, product
-from shutil import copy2
+from shutil import copy2, copystat, copyfileobj, rmtree, which
 from datetime import datetime
 from datetime import timedelta
 from io import StringIO
 from collections.abc import Mapping
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import active_children
 
 debug = True
 
 wrapper_out_file=None
 
+# prefix of stdout lines (set in parallel batch tasks to tell tasks apart)
+output_prefix = ''
+
 def xprint(*args, **kwargs):
-    if wrapper_out_file:
+    if wrapper_out_file and 'file' not in kwargs:
         print(*args, **kwargs, file=wrapper_out_file, flush=True)
+    if output_prefix and 'file' not in kwargs:
+        args = (output_prefix,) + args
     print(*args, **kwargs, flush=True)
 
 def eprint(*args, **kwargs):
@@ -105,6 +120,11 @@ class Summary:
             n = len(v.split(','))
             self.add_info('n {}'.format(opt), n, force=True)
 
+    def add_options(self, comb):
+        for i in comb:
+            opt, value = i.split(':', 1)
+            self.add_option(opt.strip(), value.strip())
+
     def add_info(self, name, value, force=False):
         if self._finished:
             self.new()
@@ -121,20 +141,31 @@ class Summary:
     def finish_current(self):
         self._finished = True
 
+    def insert(self, row):
+        """insert a finished row (e.g. from a parallel task), rows are kept in "No." order"""
+        self.batch.append(row)
+        self.batch.sort(key=lambda r: r['No.'])
+        self.current = row
+        self._finished = True
+
     def _get_longest_title(self):
         title_list = []
         for task in self.batch:
             tmp_list = list(task.keys())
             if len(title_list) < len(tmp_list):
                 title_list = tmp_list
+        # columns only some tasks have (e.g. "Error Trace Depth") are appended
+        for task in self.batch:
+            title_list += [i for i in task.keys() if i not in title_list]
         return title_list
 
     def __str__(self):
         if self.current is None:
             return ''
-        lines = ['\t'.join(self._get_longest_title())]
+        title = self._get_longest_title()
+        lines = ['\t'.join(title)]
         for task in self.batch:
-            lines.append('\t'.join(str(i).replace('\n', ' ') for i in task.values()))
+            lines.append('\t'.join(str(task.get(i, '')).replace('\n', ' ') for i in title))
         return '\n'.join(lines)
     
     def print_to_file(self, file):
@@ -149,7 +180,10 @@ class BatchConfig:
     def __init__(self, cfg, summary=None):
         self.dup_option_info = OrderedDict()
         self.cfg_content = []
+        self.cfg_lines = []  # original lines
         self.summary = summary
+        self.order = None  # order of combinations, None is the ini file order
+        self.skip = set()  # combinations not to yield (e.g. done before resuming)
         if not hasattr(cfg, 'read'):
             cfg_file = open(cfg, 'r')
         else:
@@ -171,6 +205,7 @@ class BatchConfig:
                         i for i in self.dup_option_info[pre_no] if "SHOW_IN_TABLE" != i.split(':', 1)[1].strip()]
 
         for no, line in enumerate(cfg_file):
+            self.cfg_lines.append(line)
             self.cfg_content.append(line)
             line = line.rstrip()
             if len(line) == 0 or line[0] in '#;[':
@@ -196,15 +231,185 @@ class BatchConfig:
     def get(self):
         """yield cfg StringIO"""
         keys = list(self.dup_option_info.keys())
-        values = list(self.dup_option_info.values())
-        for comb in product(*values):
+        for comb in self.get_combinations():
+            if comb in self.skip:
+                continue
             for i, no in enumerate(keys):
                 self.cfg_content[no] = comb[i] + '\n'
-                opt, value = comb[i].split(':', 1)
-                if self.summary:
-                    self.summary.add_option(opt.strip(), value.strip())
+            if self.summary:
+                self.summary.add_options(comb)
             yield comb, StringIO(''.join(self.cfg_content))
 
+    def get_combinations(self):
+        """combinations in the order they are yielded by get()"""
+        combs = list(product(*self.dup_option_info.values()))
+        return combs if self.order is None else [combs[i] for i in self.order]
+
+    range_pat = re.compile(r'^(-?\d+)\s*\.\.\s*(-?\d+)$')
+
+    @classmethod
+    def get_value_domain(cls, option):
+        """parse the value of "name: value" into a set of elements ({a, b}) or a (low, high) range (a..b), else None"""
+        v = option.split(':', 1)[1].replace('[model value]', '').replace('<symmetrical>', '').strip()
+        if v.startswith('{') and v.endswith('}'):
+            return frozenset(i.strip() for i in v[1:-1].split(',') if i.strip())
+        range_match = cls.range_pat.match(v)
+        if range_match:
+            return int(range_match.group(1)), int(range_match.group(2))
+        return None
+
+    @classmethod
+    def get_value_size(cls, option):
+        """number of elements of a set or range value, None if the value is not sized"""
+        domain = cls.get_value_domain(option)
+        if isinstance(domain, frozenset):
+            return len(domain)
+        if domain is not None:
+            return max(0, domain[1] - domain[0] + 1)
+        return None
+
+    @classmethod
+    def dominates(cls, comb, other):
+        """check if comb is larger than other: each set/range value contains the other one, other values are equal"""
+        if comb == other:
+            return False
+        for option, other_option in zip(comb, other):
+            if option == other_option:
+                continue
+            domain, other_domain = cls.get_value_domain(option), cls.get_value_domain(other_option)
+            if isinstance(domain, frozenset) and isinstance(other_domain, frozenset):
+                if not other_domain <= domain:
+                    return False
+            elif isinstance(domain, tuple) and isinstance(other_domain, tuple):
+                if not domain[0] <= other_domain[0] <= other_domain[1] <= domain[1]:
+                    return False
+            else:
+                return False
+        return True
+
+    @classmethod
+    def find_dominated(cls, comb, violated):
+        """get the "No." of a combination in violated ([(comb, No.)]) that comb dominates, or None"""
+        for other, no in violated:
+            if cls.dominates(comb, other):
+                return no
+        return None
+
+    @staticmethod
+    def read_history(history_files, spec=None):
+        """read rows of previous summary csv files (or rows of spec in run history databases)"""
+        rows = []
+        for history_file in history_files:
+            try:
+                if history_file.endswith('.sqlite'):
+                    rows += RunHistory(history_file).get_rows(spec)
+                    continue
+                with open(history_file, encoding='utf-8-sig') as f:
+                    rows += list(csv.DictReader(f))
+            except (OSError, sqlite3.Error) as e:
+                eprint('Warning: failed to read history "{}": {}'.format(history_file, e))
+        return rows
+
+    @staticmethod
+    def is_complete_row(row):
+        """check if a summary row is an exhaustive run that TLC finished normally (its counts are not truncated)"""
+        if row.get('Early Stop') or not row.get('End Time'):
+            return False
+        try:
+            return (int(row.get('Queue Size')) == 0 and
+                    int(row.get('Exit Status')) in TLCOutputParser.normal_exit_states)
+        except (ValueError, TypeError):
+            return False
+
+    def get_history_cost(self, comb, history):
+        """distinct states of the combination in a previous summary, or None"""
+        for row in history:
+            if not self.is_complete_row(row):
+                continue
+            if all(row.get(opt.title()) == v for opt, v in (self._get_summary_option(i) for i in comb)):
+                try:
+                    return int(row.get('Distinct States') or '')
+                except (ValueError, TypeError):
+                    pass
+        return None
+
+    @staticmethod
+    def _get_summary_option(option):
+        """(name, value) as shown in the summary table (see Summary.add_option)"""
+        opt, value = (i.strip() for i in option.split(':', 1))
+        v = value.replace('[model value]', '').replace('<symmetrical>', '').strip()
+        return opt, v if v else value
+
+    def sort_by_cost(self, history=None):
+        """run the cheapest combinations first
+
+        The cost is the distinct states of the combination in history (rows of previous summaries),
+        combinations without history follow, ordered by the product of their set/range sizes.
+        """
+        combs = list(product(*self.dup_option_info.values()))
+
+        def cost(i):
+            history_cost = self.get_history_cost(combs[i], history) if history else None
+            if history_cost is not None:
+                return 0, history_cost
+            size = 1
+            for option in combs[i]:
+                size *= self.get_value_size(option) or 1
+            return 1, size
+
+        self.order = sorted(range(len(combs)), key=cost)
+
+    def get_config_str(self):
+        """get config content of the first combination"""
+        content = self.cfg_content.copy()
+        for no in self.dup_option_info:
+            content[no] = self.dup_option_info[no][0] + '\n'
+        return ''.join(content)
+
+    def get_config(self):
+        """get ConfigParser of the first combination (e.g. to read [wrapper] options before running)"""
+        return read_config(StringIO(self.get_config_str()))[0]
+
+    def get_swept_options(self):
+        """names of options that have several values"""
+        return {i[0].split(':', 1)[0].strip() for i in self.dup_option_info.values()}
+
+
+def unshare_file(path):
+    """copy on write: replace a hardlinked or symlinked (i.e. shared) file by a private copy"""
+    if not os.path.islink(path) and os.stat(path).st_nlink <= 1:
+        return
+    tmp_path = path + '.cow'
+    copy2(path, tmp_path)  # follows symlinks
+    os.chmod(tmp_path, os.stat(tmp_path).st_mode | 0o200)  # snapshot files are read-only
+    os.replace(tmp_path, path)
+
+
+def remove_shared_file(path):
+    """remove a hardlinked or symlinked (i.e. shared) file that is about to be rewritten, so the link target is kept"""
+    if os.path.islink(path) or (os.path.exists(path) and os.stat(path).st_nlink > 1):
+        os.remove(path)
+
+
+def read_config(config_file):
+    """read config file (path or file object), return (ConfigParser, config str)"""
+    if not hasattr(config_file, 'read'):
+        config_file = open(config_file, 'r')
+    config_str = config_file.read()
+    config_file.close()
+    cfg = ConfigParser()
+    cfg.optionxform = str  # case sensitive
+    cfg.read_string(config_str)
+    return cfg, config_str
+
+
+def get_boolean_or_value(cfg, section, option, fallback):
+    """an option that is a boolean (true/false, yes/no, on/off, 1/0) or a value (e.g. a path), return bool or str"""
+    try:
+        return cfg.getboolean(section, option, fallback=fallback)
+    except ValueError:
+        return cfg.get(section, option)
+
 
 class TLCConfigFile:
     """generate TLC config file: MC.cfg and MC.tla"""
@@ -264,6 +469,7 @@ class TLCConfigFile:
                 break
         if not find_extends and module_idx != -1:
             lines.insert(module_idx + 1, 'EXTENDS ' + more + '\n')
+        unshare_file(self.target_tla_file)
         with open(self.target_tla_file, 'w') as f:
             f.writelines(lines)
 
@@ -446,6 +652,8 @@ class TLCConfigFile:
         output_cfg_fn = self.output_cfg_fn
         output_tla_fn = self.output_tla_fn
         output_tla_constants_fn = self.output_tla_constants_fn
+        for fn in filter(None, (output_cfg_fn, output_tla_fn, output_tla_constants_fn)):
+            remove_shared_file(fn)
         with open(output_cfg_fn, 'w') as cfg_f:
             cfg_f.write('{} on {}\n'.format(self.tag, datetime.now()))
             cfg_f.write('\n\n'.join(filter(None, self.output_cfg)))
@@ -502,7 +710,7 @@ class ReplaceInit:
         except ModuleNotFoundError:
             eprint('Warning:', 'failed to import "trace_reader",', '"init state" is disabled')
             return ''
-        tr = TraceReader()
+        tr = TraceReader()  # choosers get dicts, init_trace_reader may set tr.lazy = True
         if hasattr(self.init_module, 'init_trace_reader'):
             if debug:
                 eprint('Debug: calling "init_trace_reader"')
@@ -550,6 +758,1132 @@ class ReplaceInit:
             eprint('Debug: replaced Init TLA+ file:', self.tla_file)
 
 
+class ResultCache:
+    """Content-addressed TLC result cache, keyed by the fingerprint of model files, TLC cmd and jars"""
+
+    default_cache_dir = 'MC_cache'
+    _jar_digests = {}  # jar path -> (mtime, size, digest)
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def jar_digest(cls, jar):
+        """sha256 of a jar (identifies the tla2tools.jar version), computed once per jar"""
+        try:
+            stat = os.stat(jar)
+        except OSError:
+            return ''
+        cached = cls._jar_digests.get(jar)
+        if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+            return cached[2]
+        h = hashlib.sha256()
+        with open(jar, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        cls._jar_digests[jar] = (stat.st_mtime, stat.st_size, h.hexdigest())
+        return h.hexdigest()
+
+    @classmethod
+    def fingerprint(cls, model_dir, cmd, classpath):
+        """hash the .tla/.cfg files in model_dir (without generated timestamps), cmd and classpath jars"""
+        h = hashlib.sha256()
+        for jar in classpath.split(':'):
+            h.update(cls.jar_digest(jar).encode() + b'\0')
+        for arg in cmd:
+            if arg != classpath:  # the paths of jars do not matter, their contents do
+                h.update(arg.replace(model_dir, '.').encode() + b'\0')
+        for fn in sorted(os.listdir(model_dir)):
+            if not fn.endswith(('.tla', '.cfg')):
+                continue
+            h.update(fn.encode() + b'\0')
+            with open(os.path.join(model_dir, fn)) as f:
+                for line in f:
+                    if not line.startswith(TLCConfigFile.tag):
+                        h.update(line.encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _path(self, fingerprint):
+        return os.path.join(self.cache_dir, fingerprint + '.pickle')
+
+    def get(self, fingerprint):
+        """get the cached entry, or None"""
+        try:
+            with open(self._path(fingerprint), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def put(self, fingerprint, entry):
+        """save an entry (atomically, parallel tasks may share the cache dir)"""
+        tmp_path = '{}.{}.tmp'.format(self._path(fingerprint), os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entry, f)
+        os.replace(tmp_path, self._path(fingerprint))
+
+
+class ClassDataSharing:
+    """JVM AppCDS archive of the classpath, keyed by the jar checksums and the JDK version
+
+    The first run dumps a dynamic archive at exit (-XX:ArchiveClassesAtExit, JDK 13+),
+    later runs map it (-XX:SharedArchiveFile) to skip class loading. -Xshare:auto makes the JVM ignore unusable archives.
+    """
+
+    default_archive_dir = 'MC_cds'
+    min_java_version = 13
+    _java_version = None  # java -version output, computed once
+
+    def __init__(self, archive_dir, classpath):
+        self.archive_dir = archive_dir
+        self.classpath = classpath
+        self.archive = None
+        self.tmp_archive = None
+        version = self.get_java_version()
+        major = self.get_major_version(version)
+        if major is None or major < self.min_java_version:
+            xprint('Warning: class data sharing needs JDK {}+, "{}" found'.format(
+                self.min_java_version, version.split('\n', 1)[0] if version else 'none'))
+            return
+        os.makedirs(archive_dir, exist_ok=True)
+        h = hashlib.sha256(version.encode() + b'\0')
+        for jar in classpath.split(':'):
+            h.update(ResultCache.jar_digest(jar).encode() + b'\0')
+        self.archive = os.path.join(archive_dir, 'tlc_{}.jsa'.format(h.hexdigest()[:16]))
+
+    @classmethod
+    def get_java_version(cls):
+        if cls._java_version is None:
+            try:
+                cls._java_version = subprocess.run(['java', '-version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                                   universal_newlines=True, timeout=60).stdout.strip()
+            except (OSError, subprocess.SubprocessError):
+                cls._java_version = ''
+        return cls._java_version
+
+    @staticmethod
+    def get_major_version(version):
+        """'openjdk version "17.0.2"' -> 17, 'java version "1.8.0_292"' -> 8"""
+        match = re.search(r'version "(\d+)(?:\.(\d+))?', version)
+        if not match:
+            return None
+        major = int(match.group(1))
+        return int(match.group(2) or 0) if major == 1 else major
+
+    def get_args(self):
+        """java options to use the archive, or to dump it if it does not exist"""
+        if self.archive is None:
+            return []
+        if os.path.isfile(self.archive):
+            return ['-XX:SharedArchiveFile=' + self.archive, '-Xshare:auto']
+        # parallel tasks may dump at the same time, the last one wins
+        self.tmp_archive = '{}.{}.tmp'.format(self.archive, os.getpid())
+        return ['-XX:ArchiveClassesAtExit=' + self.tmp_archive]
+
+    def get_mode(self):
+        if self.archive is None:
+            return 'off'
+        return 'dump' if self.tmp_archive else 'use'
+
+    def finish(self):
+        """move the dumped archive in place (it is not written if the JVM was killed)"""
+        if self.tmp_archive and os.path.isfile(self.tmp_archive):
+            if os.path.getsize(self.tmp_archive) > 0:
+                os.replace(self.tmp_archive, self.archive)
+            else:
+                os.remove(self.tmp_archive)
+
+
+class RunHistory:
+    """SQLite database of all tasks: config, fingerprints, cmd, progress samples, final counts and summary row"""
+
+    default_history_file = 'MC_history.sqlite'
+    schema = '''
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            spec TEXT, model_name TEXT, model_dir TEXT, combination TEXT, ini TEXT,
+            fingerprint TEXT, spec_digest TEXT, jar_digest TEXT, cmd TEXT,
+            start_time TEXT, end_time TEXT, duration REAL,
+            diameter INTEGER, total_states INTEGER, distinct_states INTEGER, queued_states INTEGER,
+            exit_status INTEGER, errors INTEGER, warnings INTEGER, early_stop TEXT, row TEXT, cached_from TEXT);
+        CREATE INDEX IF NOT EXISTS runs_spec ON runs (spec, combination);
+        CREATE TABLE IF NOT EXISTS progress (
+            run_id INTEGER REFERENCES runs (id), elapsed REAL, diameter INTEGER, total_states INTEGER,
+            distinct_states INTEGER, queued_states INTEGER, sample TEXT);
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def connect(self):
+        # parallel tasks share the database
+        db = sqlite3.connect(self.filename, timeout=60)
+        db.row_factory = sqlite3.Row
+        db.executescript(self.schema)
+        if 'cached_from' not in {i['name'] for i in db.execute('PRAGMA table_info(runs)')}:  # older databases
+            db.execute('ALTER TABLE runs ADD COLUMN cached_from TEXT')
+        return db
+
+    def add(self, spec, model_name, model_dir, combination, ini, cmd, classpath, result, row, samples):
+        """record a task (row "Cached From" is set if the result is reused from the result cache), return its id"""
+        duration = row.get('Duration')
+        values = OrderedDict([
+            ('spec', spec), ('model_name', model_name), ('model_dir', model_dir), ('combination', combination),
+            ('ini', ini), ('fingerprint', ResultCache.fingerprint(model_dir, cmd, classpath)),
+            ('spec_digest', ResultCache.fingerprint(model_dir, [], '')),
+            ('jar_digest', ','.join(ResultCache.jar_digest(i) for i in classpath.split(':'))),
+            ('cmd', json.dumps(cmd)), ('start_time', str(row.get('Start Time'))), ('end_time', str(row.get('End Time'))),
+            ('duration', duration.total_seconds() if isinstance(duration, timedelta) else None),
+            ('diameter', result['diameter']), ('total_states', result['total states']),
+            ('distinct_states', result['distinct states']), ('queued_states', result['queued states']),
+            ('exit_status', result['exit state']), ('errors', result['message counts']['errors']),
+            ('warnings', result['message counts']['warnings']), ('early_stop', result['early stop']),
+            ('row', json.dumps(row, default=str)), ('cached_from', row.get('Cached From'))])
+        db = self.connect()
+        try:
+            with db:
+                cursor = db.execute('INSERT INTO runs ({}) VALUES ({})'.format(
+                    ', '.join(values), ', '.join('?' * len(values))), list(values.values()))
+                run_id = cursor.lastrowid
+                db.executemany('INSERT INTO progress VALUES (?, ?, ?, ?, ?, ?, ?)', [
+                    (run_id, i['elapsed'], i['diameter'], i['total states'], i['distinct states'], i['queued states'],
+                     json.dumps(i, default=str)) for i in samples])
+        finally:
+            db.close()
+        return run_id
+
+    def query(self, spec=None, combination=None):
+        """runs (oldest first) of spec whose combination contains the combination string"""
+        where, args = [], []
+        if spec:
+            where.append('spec = ?')
+            args.append(spec)
+        if combination:
+            where.append('combination LIKE ?')
+            args.append('%{}%'.format(combination))
+        db = self.connect()
+        try:
+            return db.execute('SELECT * FROM runs {} ORDER BY spec, combination, id'.format(
+                'WHERE ' + ' AND '.join(where) if where else ''), args).fetchall()
+        finally:
+            db.close()
+
+    def get_rows(self, spec=None):
+        """summary rows of runs (e.g. for "batch history")"""
+        return [json.loads(i['row'], object_pairs_hook=OrderedDict) for i in self.query(spec)]
+
+    def get_throughput(self, spec=None, combination=None):
+        """throughput history table, cached results are not runs of TLC"""
+        table = []
+        for run in self.query(spec, combination):
+            if run['cached_from']:
+                continue
+            duration = run['duration']
+            table.append(OrderedDict([
+                ('Id', run['id']), ('Spec', run['spec']), ('Combination', run['combination']),
+                ('Start Time', run['start_time']), ('Duration', duration), ('Distinct States', run['distinct_states']),
+                ('Distinct/Sec', round(run['distinct_states'] / duration, 1)
+                 if duration and run['distinct_states'] is not None else None),
+                ('Exit Status', run['exit_status']), ('Jar', run['jar_digest'][:12]),
+                ('Spec Digest', run['spec_digest'][:12])]))
+        return table
+
+
+class SpecFilesCopier:
+    """Copy .tla files into model dirs: copy, hardlink, reflink or symlink to a shared read-only snapshot dir"""
+
+    strategies = ('copy', 'hardlink', 'reflink', 'snapshot')
+    snapshot_prefix = 'MC_snapshot_'
+    FICLONE = 0x40049409  # linux/fs.h
+
+    def __init__(self, strategy='copy'):
+        if strategy not in self.strategies:
+            raise ValueError('copy strategy should be one of: {}'.format(', '.join(self.strategies)))
+        self.strategy = strategy
+        self._warned = False
+
+    def _fallback(self, src, dst, e):
+        if debug and not self._warned:
+            self._warned = True
+            eprint('Debug: {} failed ({}), fall back to copy'.format(self.strategy, e))
+        copy2(src, dst)
+
+    def _hardlink(self, src, dst):
+        try:
+            os.link(src, dst)
+        except OSError as e:
+            self._fallback(src, dst, e)
+
+    def _reflink(self, src, dst):
+        try:
+            import fcntl
+            with open(src, 'rb') as src_f, open(dst, 'wb') as dst_f:
+                fcntl.ioctl(dst_f.fileno(), self.FICLONE, src_f.fileno())
+            copystat(src, dst)
+        except (OSError, ImportError) as e:
+            self._fallback(src, dst, e)
+
+    def get_snapshot_dir(self, src_dir, files):
+        """get (create if needed) the read-only snapshot dir of files, named by the hash of their contents"""
+        h = hashlib.sha256()
+        for file in files:
+            h.update(file.encode() + b'\0')
+            with open(os.path.join(src_dir, file), 'rb') as f:
+                h.update(f.read())
+            h.update(b'\0')
+        snapshot_dir = os.path.join(src_dir, self.snapshot_prefix + h.hexdigest()[:16])
+        if not os.path.isdir(snapshot_dir):
+            tmp_dir = '{}.{}.tmp'.format(snapshot_dir, os.getpid())
+            os.makedirs(tmp_dir, exist_ok=True)
+            for file in files:
+                copy2(os.path.join(src_dir, file), tmp_dir)
+                os.chmod(os.path.join(tmp_dir, file), 0o444)
+            try:
+                os.rename(tmp_dir, snapshot_dir)
+            except OSError:  # created by another task
+                rmtree(tmp_dir, ignore_errors=True)
+        return snapshot_dir
+
+    def copy(self, src_dir, model_dir):
+        """copy all .tla files in src_dir to model_dir"""
+        files = sorted(i for i in os.listdir(src_dir) if i.endswith('.tla') and os.path.isfile(os.path.join(src_dir, i)))
+        if self.strategy == 'snapshot':
+            src_dir = os.path.realpath(self.get_snapshot_dir(src_dir, files))
+        for file in files:
+            src, dst = os.path.join(src_dir, file), os.path.join(model_dir, file)
+            if self.strategy == 'copy':
+                copy2(src, dst)
+                continue
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if self.strategy == 'snapshot':
+                os.symlink(src, dst)
+            else:
+                getattr(self, '_' + self.strategy)(src, dst)
+
+
+class TLCOutputParser:
+    """Incremental parser of TLC tool mode output ("@!@!@STARTMSG code:type" ... "@!@!@ENDMSG code")"""
+
+    # message types, see https://github.com/tlaplus/tlaplus/blob/master/tlatools/org.lamport.tlatools/src/tlc2/output/MP.java
+    # (-1 is for lines outside of messages)
+    message_type_key = ('info', 'errors', 'tlc bug', 'warnings', 'error trace', 'other msg')
+    result_key = ['start time', 'finish time', 'time consuming',
+                  'diameter', 'total states', 'distinct states', 'queued states',
+                  'info', 'errors', 'tlc bug', 'warnings', 'error trace', 'other msg',
+                  'coverage', 'exit state', 'received signal', 'early stop']
+    result_key_is_list = ['info', 'errors', 'tlc bug', 'warnings', 'error trace', 'other msg', 'coverage']
+
+    # message code -> handler method,
+    # see https://github.com/tlaplus/tlaplus/blob/master/tlatools/org.lamport.tlatools/src/tlc2/output/EC.java
+    handlers = {
+        2185: '_on_starting',          # Starting...
+        2186: '_on_finished',          # Finished in...
+        2188: '_on_simulation_mode',   # Running Random Simulation...
+        2190: '_on_init_states',       # Finished computing initial states ...
+        2194: '_on_depth',             # The depth of the complete state graph search is ...
+        2199: '_on_final_stats',       # ... states generated, ... distinct states found, ... states left on queue.
+        2200: '_on_progress',          # Progress...
+        2206: '_on_progress',          # Progress... (DFID)
+        2209: '_on_progress',          # Progress... (simulation)
+        2201: '_on_coverage_start',    # The coverage statistics
+        2221: '_on_coverage',          # coverage msg detail
+        2772: '_on_coverage',          # coverage of next-state actions
+        2773: '_on_coverage',          # coverage of initial predicates
+        2774: '_on_coverage',          # coverage of properties
+        2775: '_on_coverage',          # coverage msg detail with cost
+        2778: '_on_coverage',          # coverage of constraints
+        2202: '_on_coverage_end',      # End of statistics
+    }
+
+    progress_pat = re.compile(r'Progress\(%?(-?[\d,]+)%?\) at (.*): ([\d,]+) s.*, (-?[\d,]+) d.*, (-?[\d,]+) s')
+    final_stats_pat = re.compile(r'([\d,]+) states generated, ([\d,]+) distinct states found, (-?[\d,]+) states left')
+    time_pat = re.compile(r'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)')
+
+    def __init__(self, result=None, on_progress=None, on_coverage_end=None):
+        """on_progress(time_consuming) is called on progress, on_coverage_end() at the end of coverage statistics"""
+        self.result = result if result is not None else self.new_result()
+        self.on_progress = on_progress
+        self.on_coverage_end = on_coverage_end
+        self.message_code = -1
+        self.message_type = -1
+        self.lines = []
+        self.finished = False
+        self.simulation_mode = False
+
+    @classmethod
+    def new_result(cls, ring_size=None):
+        """empty result, message lists are bounded to the recent ring_size messages if ring_size is set"""
+        result = OrderedDict(zip_longest(cls.result_key, tuple()))  # fill None
+        for key in cls.result_key_is_list:
+            # coverage is reset on each report
+            result[key] = deque(maxlen=ring_size) if ring_size and key != 'coverage' else []
+        # number of messages of each type (list lengths are bounded in streaming mode)
+        result['message counts'] = OrderedDict((key, 0) for key in cls.message_type_key)
+        return result
+
+    def feed(self, line):
+        """process a line of TLC output"""
+        line = line.rstrip()
+        if self.message_code == -1 and line.startswith('@!@!@STARTMSG'):
+            self._process_message()
+            self.message_code, self.message_type = tuple(int(i) for i in line.split(' ')[1].split(':'))
+        elif self.message_code != -1 and line.startswith('@!@!@ENDMSG ' + str(self.message_code)):
+            self._process_message()
+            self.message_code, self.message_type = -1, -1
+        else:
+            self.lines.append(line)
+
+    def close(self):
+        """process the remaining lines"""
+        self._process_message()
+
+    def _process_message(self):
+        if len(self.lines) == 0:
+            return
+        line = '\n'.join(self.lines)
+        self.lines = []
+        key = self.message_type_key[self.message_type]
+        self.result[key].append((datetime.now(), line))
+        self.result['message counts'][key] += 1
+        handler = self.handlers.get(self.message_code)
+        if handler:
+            getattr(self, handler)(line)
+
+    def _progress(self):
+        if self.on_progress:
+            self.on_progress(self.result['time consuming'])
+
+    def _on_starting(self, line):
+        self.result['start time'] = datetime.strptime(line, 'Starting... (%Y-%m-%d %H:%M:%S)')
+
+    def _on_finished(self, line):
+        self.result['finish time'] = datetime.strptime(line.split('at')[1], ' (%Y-%m-%d %H:%M:%S)')
+        if self.result['start time'] is not None:
+            self.result['time consuming'] = self.result['finish time'] - self.result['start time']
+        self.finished = True
+
+    def _on_simulation_mode(self, line):
+        self.simulation_mode = True
+
+    def _on_progress(self, line):
+        if self.message_code == 2209:
+            self.simulation_mode = True
+        progress_match = self.progress_pat.match(line)
+        if not progress_match:
+            if debug:
+                eprint('Debug:', 'Please report this bug: match failed: "{}".'.format(line))
+            return
+        groups = progress_match.groups()
+        self.result['diameter'] = int(groups[0].replace(',', ''))
+        self.result['total states'] = int(groups[2].replace(',', ''))
+        self.result['distinct states'] = int(groups[3].replace(',', ''))
+        self.result['queued states'] = int(groups[4].replace(',', ''))
+        current_time = datetime.strptime(groups[1], '%Y-%m-%d %H:%M:%S')
+        if self.result['start time'] is not None:
+            self.result['time consuming'] = current_time - self.result['start time']
+        self._progress()
+
+    def _on_init_states(self, line):
+        states = int(line.split(':')[1].split(' ')[1])
+        self.result['diameter'] = 0
+        self.result['total states'] = states
+        self.result['distinct states'] = states
+        self.result['queued states'] = states
+        time_match = self.time_pat.search(line)
+        current_time = datetime.strptime(time_match.group(1), '%Y-%m-%d %H:%M:%S') if time_match else datetime.now()
+        if self.result['start time'] is not None:
+            self.result['time consuming'] = current_time - self.result['start time']
+        self._progress()
+
+    def _on_final_stats(self, line):
+        final_stats_match = self.final_stats_pat.match(line)
+        if final_stats_match:
+            groups = [int(i.replace(',', '')) for i in final_stats_match.groups()]
+            self.result['total states'], self.result['distinct states'], self.result['queued states'] = groups
+
+    def _on_depth(self, line):
+        self.result['diameter'] = int(line.split(' ')[9].rstrip('.'))
+
+    def _on_coverage_start(self, line):
+        self.result['coverage'] = [line]
+
+    def _on_coverage(self, line):
+        self.result['coverage'].append(line)
+
+    def _on_coverage_end(self, line):
+        if self.on_coverage_end:
+            self.on_coverage_end()
+
+    @classmethod
+    def parse_file(cls, file):
+        """replay a TLC output file (e.g. MC.out), return the parser"""
+        parser = cls()
+        if not hasattr(file, 'read'):
+            file = open(file)
+        with file as f:
+            for line in f:
+                parser.feed(line)
+        parser.close()
+        return parser
+
+    invariant_violated_pat = re.compile(r'Invariant \S+ is violated')
+    # exit codes of TLC runs that finished: success (0), assumption, deadlock, safety and liveness violations (10-13),
+    # assertion or spec evaluation failures (14); 150/151 are spec/config parse errors, 152 is a too large state
+    # space and 153 a system error (e.g. out of memory)
+    normal_exit_states = {0, 10, 11, 12, 13, 14}
+
+    @classmethod
+    def is_invariant_violated(cls, result):
+        """check if an error of the result is an invariant violation"""
+        return any(cls.invariant_violated_pat.match(msg) for _, msg in result['errors'])
+
+    @classmethod
+    def is_finished(cls, result):
+        """check if TLC finished normally (not killed, out of memory or a system error)"""
+        return result['finish time'] is not None and result['exit state'] in cls.normal_exit_states
+
+    def add_to_summary(self, summary):
+        """add parsed result to the current row of summary"""
+        result = self.result
+        summary.init_title(is_simulation=self.simulation_mode)
+        summary.add_info('Traces' if self.simulation_mode else 'Diameter', result['diameter'])
+        summary.add_info('States Found', result['total states'])
+        summary.add_info('Distinct States', result['distinct states'])
+        summary.add_info('Queue Size', result['queued states'])
+        summary.add_info('Start Time', result['start time'])
+        summary.add_info('End Time', result['finish time'])
+        summary.add_info('Duration', result['time consuming'])
+        summary.add_info('Warnings', result['message counts']['warnings'])
+        summary.add_info('Errors', result['message counts']['errors'])
+        if result['message counts']['error trace']:
+            summary.add_info('Error Trace Depth', result['message counts']['error trace'], force=True)
+
+
+class CoverageProfile:
+    """Per-action and per-expression records of TLC coverage statistics, a snapshot for each coverage report
+
+    Only the latest snapshot is kept in memory, save() appends it to a JSON Lines file.
+    """
+
+    action_pat = re.compile(r'^<(\S+) (line \d+, col \d+ to line \d+, col \d+ of module \S+)>(?:: ([\d,]+):([\d,]+))?$')
+    expression_pat = re.compile(r'^([\s|]*)(line \d+, col \d+ to line \d+, col \d+ of module \S+): ([\d,]+)(?::([\d,]+))?$')
+    record_key = ('kind', 'action', 'location', 'level', 'count', 'distinct', 'cost')
+
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot
+
+    @classmethod
+    def parse(cls, lines):
+        """parse coverage message lines into (report time, records)
+
+        Actions ("<Next line ...>: distinct:found") have count (states found) and distinct;
+        expressions ("  |line ...: count[:cost]") belong to the preceding action, level is their nesting depth
+        """
+        report_time = None
+        records = []
+        action = None
+        for line in chain.from_iterable(i.split('\n') for i in lines):
+            time_match = TLCOutputParser.time_pat.search(line) if report_time is None else None
+            if time_match:
+                report_time = time_match.group(1)
+                continue
+            action_match = cls.action_pat.match(line.strip())
+            if action_match:
+                action = action_match.group(1)
+                record = OrderedDict(zip_longest(cls.record_key, tuple()))
+                record['kind'] = 'action' if action_match.group(3) is not None else 'property'
+                record['action'], record['location'], record['level'] = action, action_match.group(2), 0
+                if action_match.group(3) is not None:
+                    record['distinct'] = int(action_match.group(3).replace(',', ''))
+                    record['count'] = int(action_match.group(4).replace(',', ''))
+                records.append(record)
+                continue
+            expression_match = cls.expression_pat.match(line)
+            if expression_match:
+                indent, location, count, cost = expression_match.groups()
+                record = OrderedDict(zip_longest(cls.record_key, tuple()))
+                record['kind'], record['action'], record['location'] = 'expression', action, location
+                record['level'] = indent.count('|') or len(indent) // 2
+                record['count'] = int(count.replace(',', ''))
+                record['cost'] = int(cost.replace(',', '')) if cost is not None else None
+                records.append(record)
+        return report_time, records
+
+    def add_snapshot(self, lines):
+        """parse a coverage report into the latest snapshot, return True if it has records"""
+        report_time, records = self.parse(lines)
+        if records:
+            self.snapshot = OrderedDict([('time', report_time), ('records', records)])
+        return bool(records)
+
+    def get_records(self):
+        """records of the last snapshot"""
+        return self.snapshot['records'] if self.snapshot else []
+
+    @staticmethod
+    def get_key(record):
+        return record['kind'], record['action'], record['location']
+
+    def get_hotspots(self, n=None):
+        """rank actions by states found, and expressions by cost (count if there is no cost)"""
+        rows = []
+        for kind in ('action', 'expression'):
+            records = [i for i in self.get_records() if i['kind'] == kind]
+            records.sort(key=lambda r: (r['cost'] or 0, r['count'] or 0), reverse=True)
+            total = sum((r['cost'] or r['count'] or 0) for r in records)
+            for rank, record in enumerate(records[:n], 1):
+                row = OrderedDict([('Rank', rank)])
+                row.update((k.title(), v) for k, v in record.items())
+                row['Share %'] = round((record['cost'] or record['count'] or 0) / total * 100, 1) if total else None
+                rows.append(row)
+        return rows
+
+    def save(self, jsonl_file, hotspots_file=None):
+        """append the last snapshot to jsonl_file and save its ranked hotspots to hotspots_file (csv)"""
+        if self.snapshot is None:
+            return
+        with open(jsonl_file, 'a') as f:
+            f.write(json.dumps(self.snapshot) + '\n')
+        if hotspots_file:
+            hotspots = self.get_hotspots()
+            if hotspots:
+                PrintTable.print_table(hotspots, filename=hotspots_file)
+
+    @classmethod
+    def load(cls, file):
+        """load the last snapshot from a json lines file saved by save(), or from TLC output (e.g. MC.out)"""
+        if file.endswith('.jsonl'):
+            snapshot = None
+            with open(file) as f:
+                for line in f:
+                    if line.strip():
+                        snapshot = line
+            return cls(json.loads(snapshot, object_pairs_hook=OrderedDict) if snapshot else None)
+        profile = cls()
+        parser = TLCOutputParser(on_coverage_end=lambda: profile.add_snapshot(parser.result['coverage']))
+        with open(file) as f:
+            for line in f:
+                parser.feed(line)
+        parser.close()
+        return profile
+
+    def diff(self, other):
+        """compare the last snapshots: rows of counts/costs of self (old) and other (new), largest changes first"""
+        old = OrderedDict((self.get_key(i), i) for i in self.get_records())
+        new = OrderedDict((self.get_key(i), i) for i in other.get_records())
+        rows = []
+        for key in list(old) + [i for i in new if i not in old]:
+            o, n = old.get(key, {}), new.get(key, {})
+            row = OrderedDict([('Kind', key[0]), ('Action', key[1]), ('Location', key[2])])
+            for name in ('count', 'distinct', 'cost'):
+                if o.get(name) is None and n.get(name) is None:
+                    continue
+                row['Old ' + name.title()], row['New ' + name.title()] = o.get(name), n.get(name)
+                row[name.title() + ' Change'] = (n.get(name) or 0) - (o.get(name) or 0)
+            rows.append(row)
+        rows.sort(key=lambda r: abs(r.get('Cost Change') or r.get('Count Change') or 0), reverse=True)
+        return rows
+
+
+class ProgressRecorder:
+    """Record progress samples of a task to a JSONL/CSV time series, with derived rates and ETA"""
+
+    fields = ['time', 'elapsed', 'diameter', 'total states', 'distinct states', 'queued states',
+              'states/s', 'distinct states/s', 'queue growth/s', 'eta']
+
+    def __init__(self, filename=None, extra_fields=(), keep_series=True):
+        """filename ends with ".csv" or ".jsonl", or None to write no series,
+        extra_fields are columns of samples from other sources (e.g. ResourceSampler.fields),
+        keep_series=False keeps only running aggregates in memory (streaming mode), series is None then"""
+        self.fields = self.fields + list(extra_fields)
+        self.filename = filename
+        self.file = None
+        self.csv_writer = None
+        self.prev = None  # the last sample of the latest second
+        self.base = None  # the last sample of the second before, rates are computed from it
+        self.last = None
+        self.samples = 0
+        self.series = [] if keep_series else None  # all samples
+        self.peak_states_rate = None
+        self.peak_distinct_rate = None
+        self.peak_queue = None
+
+    def record(self, result, extra=None):
+        """record the current progress in result (and extra fields), return the sample"""
+        if result['time consuming'] is None or result['distinct states'] is None:
+            return None
+        elapsed = result['time consuming'].total_seconds()
+        sample = OrderedDict(zip_longest(self.fields, tuple()))
+        sample['time'] = result['start time'] + result['time consuming']
+        sample['elapsed'] = elapsed
+        sample['diameter'] = result['diameter']
+        sample['total states'] = result['total states']
+        sample['distinct states'] = result['distinct states']
+        sample['queued states'] = result['queued states']
+        if extra:
+            sample.update((k, v) for k, v in extra.items() if k in sample)
+        # TLC timestamps are in seconds, samples of the same second are compared with the second before,
+        # the first second is compared with the start (nothing found yet)
+        if self.prev is None or elapsed > self.prev['elapsed']:
+            self.base = self.prev or dict.fromkeys(('elapsed', 'total states', 'distinct states', 'queued states'), 0)
+        prev = self.base
+        if elapsed > prev['elapsed']:
+            dt = elapsed - prev['elapsed']
+            sample['states/s'] = (sample['total states'] - prev['total states']) / dt
+            sample['distinct states/s'] = (sample['distinct states'] - prev['distinct states']) / dt
+            sample['queue growth/s'] = (sample['queued states'] - prev['queued states']) / dt
+            if sample['queue growth/s'] < 0:  # the queue is draining
+                sample['eta'] = sample['queued states'] / -sample['queue growth/s']
+            self.peak_states_rate = max(self.peak_states_rate or 0, sample['states/s'])
+            self.peak_distinct_rate = max(self.peak_distinct_rate or 0, sample['distinct states/s'])
+        if self.prev is None or elapsed >= self.prev['elapsed']:
+            self.prev = sample
+        self.last = sample
+        self.samples += 1
+        if sample['queued states'] is not None:
+            self.peak_queue = max(self.peak_queue or 0, sample['queued states'])
+        if self.series is not None:
+            self.series.append(sample)
+        self._write(sample)
+        return sample
+
+    def _write(self, sample):
+        if not self.filename:
+            return
+        if self.file is None:
+            self.file = open(self.filename, 'w', newline='' if self.filename.endswith('.csv') else None)
+            if self.filename.endswith('.csv'):
+                self.csv_writer = csv.writer(self.file)
+                self.csv_writer.writerow(self.fields)
+        if self.csv_writer:
+            self.csv_writer.writerow(['' if v is None else v for v in sample.values()])
+        else:
+            self.file.write(json.dumps(sample, default=str) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def mean_rates(self):
+        """(states/s, distinct states/s) over the whole run"""
+        if self.last is None or self.last['elapsed'] <= 0:
+            return None, None
+        return (self.last['total states'] / self.last['elapsed'],
+                self.last['distinct states'] / self.last['elapsed'])
+
+    def add_to_summary(self, summary):
+        """add peak and mean throughput columns, empty if no two samples are a second apart"""
+        def _round(v): return '' if v is None else round(v, 1)
+        mean_states_rate, mean_distinct_rate = self.mean_rates()
+        summary.add_info('Peak States/Sec', _round(self.peak_states_rate), force=True)
+        summary.add_info('Mean States/Sec', _round(mean_states_rate), force=True)
+        summary.add_info('Peak Distinct/Sec', _round(self.peak_distinct_rate), force=True)
+        summary.add_info('Mean Distinct/Sec', _round(mean_distinct_rate), force=True)
+        summary.add_info('Peak Queue Size', self.peak_queue, force=True)
+
+
+class ResourceSampler:
+    """Sample RSS, CPU, threads and GC time of the java process and the size of "states/" in a background thread
+
+    psutil is used if it is installed, otherwise /proc (Linux). GC time is read from a long-running
+    "jstat -gcutil <pid> <interval>" if it is available.
+    """
+
+    fields = ['rss mb', 'cpu %', 'threads', 'gc time', 'gc %', 'states mb']
+    default_interval = 5
+
+    def __init__(self, interval=default_interval, states_dir='states'):
+        self.interval = interval
+        self.states_dir = os.path.realpath(states_dir)
+        self.last = None
+        self.samples = 0
+        self._peak = {}  # field -> peak
+        self._total = {}  # field -> (sum, count)
+        self.has_jstat = True
+        self._jstat = None
+        self._gc_time = None
+        self._errors = (OSError, ValueError, IndexError)  # the process has exited
+        self._thread = None
+        self._stop = threading.Event()
+        self._prev = None  # (time, cpu seconds, gc seconds)
+        self.gc_time = None  # of the last sample reporting it
+
+    def start(self, pid):
+        """start sampling pid (a new process after a retry continues the series)"""
+        self.pid = pid
+        self._prev = None
+        self._psutil_process = None
+        self._stop_jstat()
+        self._gc_time = None
+        try:
+            import psutil
+            self._errors = (OSError, ValueError, IndexError, psutil.Error)
+            self._psutil_process = psutil.Process(pid)
+        except ImportError:
+            pass
+        except Exception as e:  # the process has exited
+            if debug:
+                eprint('Debug: resource sampling:', e)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self._stop_jstat()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except self._errors:  # the process has exited
+                break
+
+    def _read_process(self):
+        """(rss bytes, cpu seconds, threads)"""
+        if self._psutil_process is not None:
+            with self._psutil_process.oneshot():
+                cpu_times = self._psutil_process.cpu_times()
+                return (self._psutil_process.memory_info().rss, cpu_times.user + cpu_times.system,
+                        self._psutil_process.num_threads())
+        with open('/proc/{}/stat'.format(self.pid)) as f:
+            stat = f.read()
+        fields = stat[stat.rindex(')') + 2:].split()  # fields from "state" (3rd field), see proc(5)
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        return int(fields[21]) * os.sysconf('SC_PAGE_SIZE'), cpu, int(fields[17])
+
+    def _read_gc_time(self):
+        """total GC seconds ("GCT" of jstat -gcutil), or None"""
+        if not self.has_jstat:
+            return None
+        # jstat exits if the JVM is not up yet, start it again until it reports
+        if self._jstat is None or (self._gc_time is None and self._jstat.poll() is not None):
+            try:
+                self._jstat = subprocess.Popen(['jstat', '-gcutil', str(self.pid), str(max(int(self.interval * 1000), 1))],
+                                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                               universal_newlines=True)
+            except OSError:
+                self.has_jstat = False
+                return None
+            threading.Thread(target=self._read_jstat, args=(self._jstat,), daemon=True).start()
+        return self._gc_time
+
+    def _read_jstat(self, jstat):
+        """keep the latest GCT printed by jstat"""
+        column = None
+        for line in jstat.stdout:
+            values = line.split()
+            if 'GCT' in values:
+                column = values.index('GCT')
+            elif column is not None and jstat is self._jstat:
+                try:
+                    self._gc_time = float(values[column])
+                except (ValueError, IndexError):  # not a JVM
+                    pass
+        jstat.stdout.close()
+
+    def _stop_jstat(self):
+        if self._jstat is not None:
+            if self._jstat.poll() is None:
+                self._jstat.terminate()
+            self._jstat.wait()
+            self._jstat = None
+
+    def _get_states_size(self):
+        size = 0
+        for root, _, files in os.walk(self.states_dir):
+            for file in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, file))
+                except OSError:  # removed by TLC
+                    pass
+        return size
+
+    def sample(self):
+        """take a sample"""
+        now = time.monotonic()
+        rss, cpu, threads = self._read_process()
+        gc_time = self._read_gc_time()
+        sample = OrderedDict(zip_longest(self.fields, tuple()))
+        sample['rss mb'] = round(rss / 1024 / 1024, 1)
+        sample['threads'] = threads
+        sample['gc time'] = gc_time
+        sample['states mb'] = round(self._get_states_size() / 1024 / 1024, 1)
+        if self._prev is not None and now > self._prev[0]:
+            dt = now - self._prev[0]
+            sample['cpu %'] = round((cpu - self._prev[1]) / dt * 100, 1)
+            if gc_time is not None and self._prev[2] is not None:
+                sample['gc %'] = round((gc_time - self._prev[2]) / dt * 100, 1)
+        self._prev = (now, cpu, gc_time)
+        # samples are written to the progress series, only aggregates are kept
+        for k, v in sample.items():
+            if v is not None:
+                self._peak[k] = max(self._peak.get(k, v), v)
+                total, count = self._total.get(k, (0, 0))
+                self._total[k] = (total + v, count + 1)
+        if gc_time is not None:
+            self.gc_time = gc_time
+        self.samples += 1
+        self.last = sample
+        return sample
+
+    def add_to_summary(self, summary):
+        """add peak and mean columns"""
+        def _mean(key):
+            total, count = self._total.get(key, (0, 0))
+            return round(total / count, 1) if count else None
+        summary.add_info('Peak RSS MB', self._peak.get('rss mb'), force=True)
+        summary.add_info('Mean RSS MB', _mean('rss mb'), force=True)
+        summary.add_info('Peak CPU %', self._peak.get('cpu %'), force=True)
+        summary.add_info('Mean CPU %', _mean('cpu %'), force=True)
+        summary.add_info('Peak Threads', self._peak.get('threads'), force=True)
+        summary.add_info('GC Time Sec', self.gc_time, force=True)
+        summary.add_info('Mean GC %', _mean('gc %'), force=True)
+        summary.add_info('Peak States MB', self._peak.get('states mb'), force=True)
+
+
+class FlightRecorderProfiler:
+    """Profile TLC with Java Flight Recorder, summarize hot methods and allocation sites with the JDK "jfr" tool"""
+
+    top_n = 10
+
+    def __init__(self, jfr_file, summary_file):
+        self.jfr_file = jfr_file
+        self.summary_file = summary_file
+        self.hot_methods = []  # [(method, percent)]
+        self.allocation_sites = []  # [(method, percent)]
+
+    @staticmethod
+    def get_java_option(jfr_file, duration=None):
+        """JFR option, records the first `duration` seconds (or the whole run if None)"""
+        settings = ['filename=' + jfr_file, 'settings=profile', 'dumponexit=true']
+        if duration:
+            settings.insert(0, 'duration={}s'.format(duration))
+        return '-XX:StartFlightRecording=' + ','.join(settings)
+
+    @staticmethod
+    def find_jfr_tool():
+        jfr = which('jfr')
+        if jfr is None and which('java'):
+            jfr = os.path.join(os.path.dirname(os.path.realpath(which('java'))), 'jfr')
+        return jfr if jfr and os.access(jfr, os.X_OK) else None
+
+    @staticmethod
+    def _get_top_frame(values):
+        frames = (values.get('stackTrace') or {}).get('frames') or []
+        if not frames:
+            return None
+        method = frames[0]['method']
+        return '{}.{}'.format(method['type']['name'], method['name'])
+
+    @classmethod
+    def _rank(cls, counter):
+        total = sum(counter.values())
+        return [(k, round(v / total * 100, 1)) for k, v in sorted(counter.items(), key=lambda kv: -kv[1])[:cls.top_n]]
+
+    def summarize(self):
+        """parse the recording, write the text summary, return False if the "jfr" tool or the recording is missing"""
+        jfr = self.find_jfr_tool()
+        if jfr is None or not os.path.isfile(self.jfr_file):
+            eprint('Warning: cannot summarize profile, {} not found'.format(
+                '"jfr" tool' if jfr is None else self.jfr_file))
+            return False
+        try:
+            output = subprocess.run([jfr, 'print', '--json', '--events', 'jdk.ExecutionSample,jdk.ObjectAllocationSample',
+                                     self.jfr_file], stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+            events = json.loads(output)['recording']['events']
+        except (OSError, subprocess.SubprocessError, ValueError, KeyError) as e:
+            eprint('Warning: failed to summarize profile:', e)
+            return False
+        samples, allocations = OrderedDict(), OrderedDict()
+        for event in events:
+            frame = self._get_top_frame(event['values'])
+            if frame is None:
+                continue
+            if event['type'] == 'jdk.ExecutionSample':
+                samples[frame] = samples.get(frame, 0) + 1
+            else:
+                allocations[frame] = allocations.get(frame, 0) + event['values'].get('weight', 1)
+        self.hot_methods = self._rank(samples)
+        self.allocation_sites = self._rank(allocations)
+        with open(self.summary_file, 'w') as f:
+            for title, ranks in (('Hot methods (% of execution samples)', self.hot_methods),
+                                 ('Allocation sites (% of allocated bytes)', self.allocation_sites)):
+                f.write(title + ':\n')
+                for method, percent in ranks:
+                    f.write('{:>6}%  {}\n'.format(percent, method))
+                f.write('\n')
+        return True
+
+    def add_to_summary(self, summary, n=3):
+        """top n hot methods and allocation sites"""
+        def _join(ranks): return '; '.join('{} {}%'.format(*i) for i in ranks[:n])
+        summary.add_info('Hot Methods', _join(self.hot_methods), force=True)
+        summary.add_info('Allocation Sites', _join(self.allocation_sites), force=True)
+
+
+class EarlyStopPolicy:
+    """Decide whether to stop TLC early from progress samples ([wrapper] "early stop ..." options)"""
+
+    def __init__(self, distinct_rate=None, samples=3, eta=None, queue=None):
+        """stop if distinct states/s < distinct_rate for `samples` consecutive samples, if the projected
+        run time (elapsed + ETA) > eta seconds, or if the queue has more than `queue` states"""
+        self.distinct_rate = distinct_rate
+        self.samples = samples
+        self.eta = eta
+        self.queue = queue
+        self.slow_samples = 0
+
+    @classmethod
+    def from_config(cls, cfg):
+        def _get(name): return cfg.getfloat('wrapper', 'early stop ' + name, fallback=None)
+        policy = cls(_get('distinct rate'), cfg.getint('wrapper', 'early stop samples', fallback=3),
+                     _get('eta'), _get('queue'))
+        return policy if policy.enabled() else None
+
+    def enabled(self):
+        return any(i is not None for i in (self.distinct_rate, self.eta, self.queue))
+
+    def check(self, sample):
+        """return the reason to stop, or None"""
+        if sample is None:
+            return None
+        if self.distinct_rate is not None and sample['distinct states/s'] is not None:
+            if sample['distinct states/s'] < self.distinct_rate:
+                self.slow_samples += 1
+                if self.slow_samples >= self.samples:
+                    return 'distinct states/s < {:g} for {} samples'.format(self.distinct_rate, self.slow_samples)
+            else:
+                self.slow_samples = 0
+        if self.eta is not None and sample['eta'] is not None and sample['elapsed'] + sample['eta'] > self.eta:
+            return 'projected run time {:.0f}s > {:g}s'.format(sample['elapsed'] + sample['eta'], self.eta)
+        if self.queue is not None and sample['queued states'] is not None and sample['queued states'] > self.queue:
+            return 'queue size {} > {:g}'.format(sample['queued states'], self.queue)
+        return None
+
+
+class RecoveryPolicy:
+    """Restart TLC from the newest checkpoint after an abnormal exit ([wrapper] "recover ..." options)"""
+
+    system_error_exit = 153  # EC.ExitStatus.ERROR_SYSTEM (e.g. out of memory)
+    out_of_memory_pat = re.compile(r'OutOfMemoryError|Java ran out of memory')
+    memory_arg_pat = re.compile(r'^(-Xmx|-XX:MaxDirectMemorySize=)(\d+)m$')
+
+    def __init__(self, retries=0, memory_factor=None):
+        """retry up to `retries` times, multiply memory by memory_factor after out of memory errors"""
+        self.retries = retries
+        self.memory_factor = memory_factor
+
+    @classmethod
+    def from_config(cls, cfg):
+        policy = cls(cfg.getint('wrapper', 'recover retries', fallback=0),
+                     cfg.getfloat('wrapper', 'recover memory factor', fallback=None))
+        return policy if policy.retries > 0 else None
+
+    @classmethod
+    def get_reason(cls, exit_state, out_of_memory):
+        """reason of an abnormal exit, or None"""
+        if out_of_memory:
+            return 'out of memory'
+        if exit_state is not None and exit_state < 0:
+            return 'killed by signal {}'.format(-exit_state)
+        if exit_state == cls.system_error_exit:
+            return 'system error'
+        return None
+
+    @staticmethod
+    def find_checkpoint(states_dir='states'):
+        """get the newest checkpoint dir (states/yyyy-MM-dd-HH-mm-ss.SSS with *.chkpt files), or None"""
+        if not os.path.isdir(states_dir):
+            return None
+        for name in sorted(os.listdir(states_dir), reverse=True):
+            path = os.path.join(states_dir, name)
+            if os.path.isdir(path) and any(i.endswith('.chkpt') for i in os.listdir(path)):
+                return os.path.realpath(path)
+        return None
+
+    def get_retry_cmd(self, cmd, checkpoint, out_of_memory):
+        """cmd to recover from checkpoint (or to restart if it is None), with more memory after out of memory errors"""
+        new_cmd = []
+        skip_next = False
+        for arg in cmd:
+            if skip_next:
+                skip_next = False
+                continue
+            if arg == '-recover':
+                skip_next = True
+                continue
+            if arg == '-cleanup':  # it would remove the checkpoint
+                continue
+            memory_arg_match = self.memory_arg_pat.match(arg)
+            if memory_arg_match and out_of_memory and self.memory_factor:
+                arg = '{}{}m'.format(memory_arg_match.group(1),
+                                     int(int(memory_arg_match.group(2)) * self.memory_factor))
+            new_cmd.append(arg)
+        if checkpoint:
+            new_cmd[-1:-1] = ['-recover', checkpoint]  # before -tool
+        return new_cmd
+
+
+class MetricsExporter:
+    """Atomically rewrite an OpenMetrics text file (e.g. for node-exporter textfile collector) with task metrics"""
+
+    prefix = 'tlc_'
+
+    def __init__(self, filename, labels):
+        self.filename = filename
+        self.labels = ','.join('{}="{}"'.format(k, self.escape(v)) for k, v in labels.items())
+
+    @staticmethod
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def write(self, result, sample=None, running=True, cached=False):
+        """write metrics of result and the latest progress sample"""
+        counts = result['message counts']
+        metrics = [
+            ('running', 'Whether TLC is running', int(running)),
+            ('cached', 'Whether the result is reused from the result cache', int(cached)),
+            ('diameter', 'Diameter (or traces in simulation mode)', result['diameter']),
+            ('states_found', 'States found', result['total states']),
+            ('distinct_states', 'Distinct states found', result['distinct states']),
+            ('queued_states', 'States left on queue', result['queued states']),
+            ('elapsed_seconds', 'Elapsed model checking time',
+             None if result['time consuming'] is None else result['time consuming'].total_seconds()),
+            ('warnings', 'Number of warnings', counts['warnings']),
+            ('errors', 'Number of errors', counts['errors']),
+            ('exit_status', 'Exit status of TLC', None if running else result['exit state']),
+            ('last_update_timestamp_seconds', 'Time of the last update', time.time()),
+        ]
+        if sample is not None:
+            metrics += [
+                ('states_per_second', 'States found per second', sample['states/s']),
+                ('distinct_states_per_second', 'Distinct states found per second', sample['distinct states/s']),
+                ('queue_growth_per_second', 'Queue size growth per second', sample['queue growth/s']),
+                ('eta_seconds', 'Estimated time until the queue is drained', sample['eta']),
+            ]
+        lines = []
+        for name, help_str, value in metrics:
+            if value is None:
+                continue
+            name = self.prefix + name
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('# HELP {} {}'.format(name, help_str))
+            lines.append('{}{{{}}} {}'.format(name, self.labels, value))
+        lines.append('# EOF\n')
+        tmp_filename = '{}.{}.tmp'.format(self.filename, os.getpid())
+        with open(tmp_filename, 'w') as f:
+            f.write('\n'.join(lines))
+        os.replace(tmp_filename, self.filename)
+
+
 class TLCWrapper:
     """TLC cmdline options"""
     _script_dir = os.path.dirname(os.path.realpath(__file__))
@@ -576,8 +1910,13 @@ class TLCWrapper:
     default_mc_user = 'MC_user.txt'
     default_mc_states = 'MC_states'
     default_mc_coverage = 'MC_coverage.txt'
+    default_mc_coverage_jsonl = 'MC_coverage.jsonl'
+    default_mc_coverage_hotspots = 'MC_coverage_hotspots.csv'
     default_mc_ini = 'MC.ini'
     default_mc_trace = 'MC_trace'
+    default_mc_progress = 'MC_progress'
+    default_mc_jfr = 'MC.jfr'
+    default_mc_profile = 'MC_profile.txt'
     default_tlcwrapper_log = 'tlcwrapper.log'
 
     task_id_number = 0
@@ -587,10 +1926,19 @@ class TLCWrapper:
     spssh_sh = os.path.join(spssh_dir, 'spssh.sh')
     spssh_cp_sh = os.path.join(spssh_dir, 'spssh_cp.sh')
 
+    # streaming mode defaults
+    default_ring_size = 1000
+    default_flush_seconds = 5
+
     def __init__(self, config_file=None, log_file=True, gen_cfg_fn=None, gen_tla_fn=None, gen_tla_constants_fn=None,
                  summary=None, is_task_id=True, is_split_user_file=True, classpath='', need_community_modules=False,
-                 log_output=False, suppress_error_trace=False):
-        """create model dir, chdir, copy files and generate tlc configfile"""
+                 log_output=False, suppress_error_trace=False, streaming=False, options_override=None,
+                 record_history=True):
+        """create model dir, chdir, copy files and generate tlc configfile
+
+        options_override is a dict of [options] values replacing those in the config file (e.g. calibrated values),
+        record_history=False keeps the run out of the run history (e.g. bounded probes)
+        """
         
         # save current dir
         self.orig_cwd = os.getcwd()
@@ -605,13 +1953,12 @@ class TLCWrapper:
 
         # open config file
         config_file = config_file if config_file is not None else self.default_config_file
-        if not hasattr(config_file, 'read'):
-            config_file = open(config_file, 'r')
-        config_str = config_file.read()
-        config_file.close()
-        self.cfg = ConfigParser()
-        self.cfg.optionxform = str  # case sensitive
-        self.cfg.read_string(config_str)
+        self.cfg, config_str = read_config(config_file)
+        self.config_str = config_str
+        self.options_override = options_override or {}
+        for k, v in self.options_override.items():
+            if 'options' in self.cfg:
+                self.cfg.set('options', k, str(v))
 
         if 'options' not in self.cfg:
             xprint('Error: config file has no "options" section, run "python3 {} -h" for help'.format(sys.argv[0]))
@@ -628,25 +1975,57 @@ class TLCWrapper:
         self.need_community_modules = need_community_modules
         if need_community_modules:
             classpath = '{}:{}'.format(classpath, self.community_jar)
-        self._tlc_cmd = ['java', '-Dtlc2.tool.impl.Tool.cdot=true', '-XX:+UseParallelGC', '-cp', classpath]
+        gc = '-XX:+Use' + self.cfg.get('options', 'gc', fallback='ParallelGC')
+        self._tlc_cmd = ['java', '-Dtlc2.tool.impl.Tool.cdot=true', gc, '-cp', classpath]
         self.classpath = classpath
 
         # open log file
         if isinstance(log_file, str):  # if log_file specified, open it before change cwd
             self.log_file = open(log_file, 'w')
+            self.log_path = os.path.realpath(log_file)
+
+        # streaming mode: log is only kept on disk, result keeps counts and a ring of recent messages
+        self.streaming = streaming or self.cfg.getboolean('wrapper', 'streaming', fallback=False)
+        self.ring_size = self.cfg.getint('wrapper', 'streaming ring size', fallback=self.default_ring_size)
+        self.flush_seconds = self.cfg.getfloat('wrapper', 'streaming flush seconds',
+                                               fallback=self.default_flush_seconds)
 
         # take model dir
         target = self.cfg.get('options', 'target')
 
+        # result cache, default dir is in the target dir
+        result_cache = get_boolean_or_value(self.cfg, 'wrapper', 'result cache', fallback=False)
+        self.result_cache = None
+        if result_cache:
+            if result_cache is True:
+                result_cache = os.path.join(os.path.dirname(os.path.realpath(target)), ResultCache.default_cache_dir)
+            self.result_cache = ResultCache(os.path.realpath(result_cache))
+
+        # run history database, default is in the target dir
+        run_history = get_boolean_or_value(self.cfg, 'wrapper', 'run history', fallback=True)
+        self.run_history = None
+        if run_history and record_history:
+            if run_history is True:
+                run_history = os.path.join(os.path.dirname(os.path.realpath(target)), RunHistory.default_history_file)
+            self.run_history = RunHistory(os.path.realpath(run_history))
+
+        # class data sharing archive, default dir is in the target dir
+        class_data_sharing = get_boolean_or_value(self.cfg, 'wrapper', 'class data sharing', fallback=False)
+        self.class_data_sharing_dir = None
+        if class_data_sharing:
+            if class_data_sharing is True:
+                class_data_sharing = os.path.join(os.path.dirname(os.path.realpath(target)),
+                                                  ClassDataSharing.default_archive_dir)
+            self.class_data_sharing_dir = os.path.realpath(class_data_sharing)
+
         TLCWrapper.task_id_number += 1
         task_id = '' if not is_task_id else '_{}'.format(TLCWrapper.task_id_number)
         model_name = self.cfg.get('options', 'model name') + datetime.now().strftime("_%Y-%m-%d_%H-%M-%S") + task_id
         os.chdir(os.path.dirname(os.path.realpath(target)))
         os.makedirs(model_name, exist_ok=True)
-        for file in os.listdir('.'):
-            if file.endswith('.tla'):
-                copy2(file, model_name)
+        SpecFilesCopier(self.cfg.get('wrapper', 'copy strategy', fallback='copy')).copy('.', model_name)
         model_dir = os.path.realpath(model_name)
+        self.model_dir = model_dir
         os.chdir(self.orig_cwd)
         need_separate_constants = self._parse_init_state(os.path.join(model_dir, os.path.basename(target)))
         os.chdir(model_dir)
@@ -664,9 +2043,11 @@ class TLCWrapper:
         # check and open log file again
         if log_file:
             if not isinstance(log_file, str):
-                self.log_file = open(self.default_mc_log, 'w')
+                self.log_file = open(self.default_mc_log, 'w', buffering=1 << 20 if self.streaming else -1)
+                self.log_path = os.path.realpath(self.default_mc_log)
         else:
             self.log_file = None
+            self.log_path = None
 
         # generate config files
         self.gen_cfg_fn = gen_cfg_fn if gen_cfg_fn is not None else self.default_mc_cfg
@@ -695,6 +2076,8 @@ class TLCWrapper:
 
         with open(self.default_mc_ini, 'w') as f:
             f.write('; {}\n; {}\n\n'.format(*self.get_cmd_str().splitlines()))
+            for k, v in self.options_override.items():
+                f.write('; OVERRIDE: {}: {}\n'.format(k, v))
             f.write(config_str)
 
         # init result and summary table
@@ -782,6 +2165,14 @@ class TLCWrapper:
         if opt.get('stop after'):
             self._tlc_cmd.insert(1, '-Dtlc2.TLC.stopAfter=' + opt.get('stop after'))
 
+        # a boolean (the whole run) or a duration in seconds
+        try:
+            self.profile, profile_seconds = opt.getboolean('profile', fallback=False), None
+        except ValueError:
+            self.profile, profile_seconds = True, opt.getint('profile')
+        if self.profile:
+            self._tlc_cmd.insert(1, FlightRecorderProfiler.get_java_option(self.default_mc_jfr, profile_seconds))
+
         mem = None
         mem_ratio = opt.getfloat('memory ratio')
         if mem_ratio:
@@ -794,11 +2185,15 @@ class TLCWrapper:
         if mem is None:
             mem = opt.getint('system memory')
         if mem:
-            direct_mem = '-XX:MaxDirectMemorySize=' + str(mem // 3 * 2) + 'm'
-            xmx = '-Xmx' + str(mem // 3) + 'm'
+            heap_ratio = opt.getfloat('heap ratio')
+            heap_mem = mem // 3 if not heap_ratio else int(mem * heap_ratio)
+            direct_mem = '-XX:MaxDirectMemorySize=' + str(mem // 3 * 2 if not heap_ratio else mem - heap_mem) + 'm'
+            xmx = '-Xmx' + str(heap_mem) + 'm'
             self._tlc_cmd.insert(1, xmx)
             self._tlc_cmd.insert(1, direct_mem)
             self._tlc_cmd.insert(1, '-Dtlc2.tool.fp.FPSet.impl=tlc2.tool.fp.OffHeapDiskFPSet')
+        if opt.get('state queue', 'disk').lower() == 'memory':
+            self._tlc_cmd.insert(1, '-Dtlc2.tool.queue.IStateQueue=StateDeque')
 
         dump_states = opt.get('dump states')
         if dump_states:
@@ -811,9 +2206,9 @@ class TLCWrapper:
                         not opt.getboolean('check deadlock'), opt.getint('coverage minute'),
                         opt.getint('simulation depth'), opt.getint('simulation seed'), opt.get('recover'),
                         opt.getboolean('gzip'), opt.getboolean('generate spec TE'), opt.getboolean('clean up'),
-                        opt.get('liveness check'), opt.getboolean('diff trace')]
+                        opt.get('liveness check'), opt.getboolean('diff trace'), opt.get('fpmem'), opt.getint('fpbits')]
         options = ['-workers', '-checkpoint', '-dfid', '-deadlock', '-coverage', '-depth', '-seed', '-recover',
-                   '-gzip', '-generateSpecTE', '-cleanup', '-lncheck', '-difftrace']
+                   '-gzip', '-generateSpecTE', '-cleanup', '-lncheck', '-difftrace', '-fpmem', '-fpbits']
         for i, j in zip(options, options_list):
             if j:
                 self.options.append(i)
@@ -904,14 +2299,7 @@ class TLCWrapper:
         subprocess.call(options)
 
     def init_result(self):
-        result_key = ['start time', 'finish time', 'time consuming',
-                      'diameter', 'total states', 'distinct states', 'queued states',
-                      'info', 'errors', 'tlc bug', 'warnings', 'error trace', 'other msg',
-                      'coverage', 'exit state', 'received signal']
-        result_key_is_list = ['info', 'errors', 'tlc bug', 'warnings', 'error trace', 'other msg', 'coverage']
-        self.result = OrderedDict(zip_longest(result_key, tuple()))  # fill None
-        for key in result_key_is_list:
-            self.result[key] = []
+        self.result = TLCOutputParser.new_result(self.ring_size if self.streaming else None)
         self.log_lines = []
 
     @staticmethod
@@ -983,8 +2371,13 @@ class TLCWrapper:
                 xprint(i)
         xprint('-' * 16)
 
-    def run(self):
-        """call tlc and analyse output"""
+    def run(self, metrics_file=None, metrics_labels=None, combination=''):
+        """call tlc and analyse output
+
+        metrics_file (default is [wrapper] "metrics file") is rewritten with OpenMetrics on each progress message,
+        "{}" in it is replaced by the model dir name. metrics_labels are added to the "model" label.
+        combination is the batch options of the task, recorded in the run history
+        """
         self.init_result()  # clear result
 
         title_printed = False
@@ -1009,76 +2402,57 @@ class TLCWrapper:
                 for k, v in zip(title_list, value_list):
                     self.summary.add_info(k, v)
 
-        progress_pat = re.compile(r'Progress\(%?(-?[\d,]+)%?\) at (.*): ([\d,]+) s.*, (-?[\d,]+) d.*, (-?[\d,]+) s')
-        # finish_pat = re.compile(r'(\d+) states generated, (\d+) distinct states found, (\d+) states left on queue')
-
-        tmp_lines = []
-        message_code = -1  # see https://github.com/tlaplus/tlaplus/blob/master/tlatools/org.lamport.tlatools/src/tlc2/output/EC.java
-        message_type = -1  # see https://github.com/tlaplus/tlaplus/blob/master/tlatools/org.lamport.tlatools/src/tlc2/output/MP.java
-        message_type_key = ('info', 'errors', 'tlc bug', 'warnings', 'error trace', 'other msg')
-        finish_flag = False
         received_signal = None  # None, signal.SIGINT, or signal.SIGQUIT
+        process = None
 
         def signal_handler(sig, frame):
             nonlocal received_signal
             received_signal = sig
+            # forward interrupts (e.g. of a parallel batch) to TLC, it gets Ctrl+C from the terminal as well
+            if sig == signal.SIGINT and process is not None and process.poll() is None:
+                process.send_signal(signal.SIGINT)
             # if sig == signal.SIGQUIT:
             #     eprint('\nReceived SIGQUIT (Ctrl+\\), will quit after current task...')
         
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGQUIT, signal_handler)
 
-        def process_message():
-            if len(tmp_lines) == 0:
-                return
-            line = '\n'.join(tmp_lines)
-            self.result[message_type_key[message_type]].append((datetime.now(), line))
-            # if message_type_key[message_type] in {'errors', 'warnings'}:
-            #     xprint('Error:' if message_type_key[message_type] == 'errors' else 'Warning:', line)
-            if message_code == 2185:  # Starting...
-                self.result['start time'] = datetime.strptime(line, 'Starting... (%Y-%m-%d %H:%M:%S)')
-            elif message_code == 2186:  # Finished in...
-                self.result['finish time'] = datetime.strptime(line.split('at')[1], ' (%Y-%m-%d %H:%M:%S)')
-                if self.result['start time'] is not None:
-                    self.result['time consuming'] = self.result['finish time'] - self.result['start time']
-                nonlocal finish_flag
-                finish_flag = True
-                # print_state(self.result['time consuming'])
-            elif message_code in {2200, 2206, 2209}:  # Progress...
-                progress_match = progress_pat.match(line)
-                if not progress_match:
-                    if debug:
-                        eprint('Debug:', 'Please report this bug: match failed: "{}".'.format(line))
-                else:
-                    groups = progress_match.groups()
-                    self.result['diameter'] = int(groups[0].replace(',', ''))
-                    self.result['total states'] = int(groups[2].replace(',', ''))
-                    self.result['distinct states'] = int(groups[3].replace(',', ''))
-                    self.result['queued states'] = int(groups[4].replace(',', ''))
-                    current_time = datetime.strptime(groups[1], '%Y-%m-%d %H:%M:%S')
-                    self.result['time consuming'] = current_time - self.result['start time']
-                    print_state(self.result['time consuming'])
-            elif message_code == 2190:  # Finished computing initial states ...
-                states = int(line.split(':')[1].split(' ')[1])
-                self.result['diameter'] = 0
-                self.result['total states'] = states
-                self.result['distinct states'] = states
-                self.result['queued states'] = states
-                print_state(str(datetime.now() - self.result['start time']).split('.')[0])
-            # elif message_code == 2199:  # ... states generated, ... distinct states found, 0 states left on queue.
-            #     groups = finish_pat.match(line).groups()
-            #     self.result['total states'] = int(groups[0])
-            #     self.result['distinct states'] = int(groups[1])
-            #     self.result['queued states'] = int(groups[2])
-            elif message_code == 2194:  # The depth of the complete state graph search is ...
-                diameter = int(line.split(' ')[9].rstrip('.'))
-                self.result['diameter'] = diameter
-            elif message_code == 2201:  # The coverage statistics
-                self.result['coverage'] = [line]
-            elif message_code == 2221:  # coverage msg detail
-                self.result['coverage'].append(line)
-            elif message_code == 2202:  # End of statistics
-                self.save_coverage()
+        progress_series = self.cfg.get('wrapper', 'progress series', fallback='false').lower()
+        if progress_series not in {'false', 'csv', 'jsonl'}:
+            raise ValueError('[wrapper] "progress series" should be one of: false, csv, jsonl')
+        resources = None
+        if self.cfg.getboolean('wrapper', 'resource sampling', fallback=False):
+            resources = ResourceSampler(self.cfg.getfloat('wrapper', 'resource sampling seconds',
+                                                          fallback=ResourceSampler.default_interval))
+        self.progress = ProgressRecorder(
+            None if progress_series == 'false' else '{}.{}'.format(self.default_mc_progress, progress_series),
+            extra_fields=ResourceSampler.fields if resources else (), keep_series=not self.streaming)
+
+        metrics = None
+        if metrics_file is None:
+            metrics_file = self.cfg.get('wrapper', 'metrics file', fallback=None)
+        if metrics_file:
+            labels = OrderedDict(model=self.cfg.get('options', 'model name'))
+            labels.update(metrics_labels or {})
+            metrics_file = os.path.join(self.orig_cwd, metrics_file.replace('{}', os.path.basename(os.getcwd())))
+            metrics = MetricsExporter(metrics_file, labels)
+
+        early_stop = EarlyStopPolicy.from_config(self.cfg)
+
+        def on_progress(time):
+            print_state(time)
+            sample = self.progress.record(self.result, resources.last if resources else None)
+            if metrics:
+                metrics.write(self.result, sample)
+            if early_stop and not self.result['early stop']:
+                self.result['early stop'] = early_stop.check(sample)
+                if self.result['early stop']:
+                    xprint('Stopping early:', self.result['early stop'])
+
+        self.coverage = CoverageProfile()
+        if os.path.exists(self.default_mc_coverage_jsonl):
+            os.remove(self.default_mc_coverage_jsonl)
+        parser = TLCOutputParser(self.result, on_progress=on_progress, on_coverage_end=self.save_coverage)
 
         options = self._tlc_cmd + self.options + ['-tool']  # tool mode
         if debug:
@@ -1086,58 +2460,195 @@ class TLCWrapper:
             eprint('Debug: cmd:', options)
         self.download_dependencies()
 
+        fingerprint = None
+        if self.result_cache is not None and self.is_cacheable():
+            fingerprint = ResultCache.fingerprint(os.getcwd(), self._tlc_cmd + self.options, self.classpath)
+            cached = self.result_cache.get(fingerprint)
+            if cached is not None:
+                self.load_cached_result(fingerprint, cached)
+                if metrics:
+                    metrics.write(self.result, running=False, cached=True)
+                self.add_run_history(combination)
+                return self.result
+
+        cds = None
+        if self.class_data_sharing_dir and not self.distributed_mode:
+            cds = ClassDataSharing(self.class_data_sharing_dir, self.classpath)
+            options = options[:1] + cds.get_args() + options[1:]
+            if debug:
+                eprint('Debug: class data sharing:', cds.get_mode(), cds.archive)
+
         with open(self.default_mc_ini, 'a') as f:
             cur_time = datetime.now()
             f.write('\n; CMD: {}\n; START TIME: {}\n'.format(options, cur_time))
+            if cds:
+                f.write('; CLASS DATA SHARING: {} {}\n'.format(cds.get_mode(), cds.archive))
             self.summary.add_info('Start Time', cur_time)
+            self.summary.add_info('End Time', datetime.now())
+
+        recovery = RecoveryPolicy.from_config(self.cfg) if not self.distributed_mode else None
+        retries = 0
+        startup_time = None
+        while True:
+            start_time = time.monotonic()
             process = subprocess.Popen(options, stdout=subprocess.PIPE, universal_newlines=True)
             if debug:
                 eprint('Debug:', 'JAVA PID: {}'.format(process.pid))
-            cur_time = datetime.now()
-            self.summary.add_info('End Time', cur_time)
-            # f.write('; END TIME: {}\n'.format(cur_time))
-
-        self.run_distributed_workers()
-
-        for msg_line in iter(process.stdout.readline, ''):
-            if msg_line == '':  # sentinel
-                process_message()
+            if resources:
+                resources.start(process.pid)
+            if retries == 0:
+                self.run_distributed_workers()
+
+            last_flush_time = time.monotonic()
+            out_of_memory = False
+            for msg_line in iter(process.stdout.readline, ''):
+                if startup_time is None:  # the JVM is up and TLC classes are loaded
+                    startup_time = time.monotonic() - start_time
+                if not self.streaming:
+                    self.log_lines.append(msg_line)
+                if self.log_file:
+                    self.log_file.write(msg_line)
+                    if not self.streaming:
+                        self.log_file.flush()
+                    elif time.monotonic() - last_flush_time >= self.flush_seconds:
+                        self.log_file.flush()
+                        last_flush_time = time.monotonic()
+                if recovery and not out_of_memory and RecoveryPolicy.out_of_memory_pat.search(msg_line):
+                    out_of_memory = True
+                parser.feed(msg_line)
+                if (parser.finished and self.distributed_mode) or received_signal or self.result['early stop']:
+                    process.terminate()
+            parser.close()
+            exit_state = process.wait()
+            if resources:
+                resources.stop()
+
+            if not recovery or retries >= recovery.retries or received_signal or self.result['early stop']:
                 break
-            self.log_lines.append(msg_line)
-            if self.log_file:
-                self.log_file.write(msg_line)
-                self.log_file.flush()
-            msg_line = msg_line.rstrip()
-            if message_code == -1 and msg_line.startswith('@!@!@STARTMSG'):
-                process_message()
-                message_code, message_type = tuple(int(i) for i in msg_line.split(' ')[1].split(':'))
-            elif message_code != -1 and msg_line.startswith('@!@!@ENDMSG ' + str(message_code)):
-                process_message()
-                message_code, message_type = -1, -1
-                tmp_lines = []
-            else:
-                tmp_lines.append(msg_line)
-            if (finish_flag == True and self.distributed_mode == True) or received_signal:
-                process.terminate()
-
-        exit_state = process.poll()
-        self.result['exit state'] = 0 if exit_state is None else exit_state
+            reason = RecoveryPolicy.get_reason(exit_state, out_of_memory)
+            if reason is None:
+                break
+            retries += 1
+            checkpoint = RecoveryPolicy.find_checkpoint()
+            options = recovery.get_retry_cmd(options, checkpoint, out_of_memory)
+            xprint('TLC exited abnormally ({}, exit status {}), retry {}/{}: {}'.format(
+                reason, exit_state, retries, recovery.retries,
+                'recovering from ' + checkpoint if checkpoint else 'no checkpoint, restarting'))
+            with open(self.default_mc_ini, 'a') as f:
+                f.write('; RETRY {}: {}, exit status {}, checkpoint: {}\n; CMD: {}\n; START TIME: {}\n'.format(
+                    retries, reason, exit_state, checkpoint, options, datetime.now()))
+            # the result is of the last attempt, the log keeps all attempts
+            self.result = TLCOutputParser.new_result(self.ring_size if self.streaming else None)
+            parser = TLCOutputParser(self.result, on_progress=on_progress, on_coverage_end=self.save_coverage)
+        self.progress.close()
+        self.progress.add_to_summary(self.summary)
+        if retries:
+            self.summary.add_info('Retries', retries, force=True)
+        if resources:
+            resources.add_to_summary(self.summary)
+        if self.profile:
+            profiler = FlightRecorderProfiler(self.default_mc_jfr, self.default_mc_profile)
+            if profiler.summarize():
+                profiler.add_to_summary(self.summary)
+                xprint('Profile summary:', os.path.realpath(self.default_mc_profile))
+
+        if self.log_file:
+            self.log_file.flush()
+        if cds:
+            cds.finish()
+            self.summary.add_info('Class Data Sharing', cds.get_mode(), force=True)
+        if startup_time is not None:
+            self.summary.add_info('Startup Time', round(startup_time, 3), force=True)
+        self.result['exit state'] = exit_state
+        if metrics:
+            metrics.write(self.result, self.progress.last, running=False)
+        counts = self.result['message counts']
+        # final counts, short runs may have no progress messages after the final statistics
+        for title, key in (('Traces' if self.simulation_mode else 'Diameter', 'diameter'),
+                           ('States Found', 'total states'), ('Distinct States', 'distinct states'),
+                           ('Queue Size', 'queued states')):
+            if self.result[key] is not None:
+                self.summary.add_info(title, self.result[key])
         self.summary.add_info('Exit Status', self.result['exit state'])
-        self.summary.add_info('Warnings', len(self.result['warnings']))
-        self.summary.add_info('Errors', len(self.result['errors']))
-        if len(self.result['error trace']):
-            self.summary.add_info('Error Trace Depth', len(self.result['error trace']), force=True)
+        self.summary.add_info('Warnings', counts['warnings'])
+        self.summary.add_info('Errors', counts['errors'])
+        if counts['error trace']:
+            self.summary.add_info('Error Trace Depth', counts['error trace'], force=True)
+        if self.result['early stop']:
+            self.summary.add_info('Early Stop', self.result['early stop'], force=True)
         with open(self.default_mc_ini, 'a') as f:
+            if self.result['early stop']:
+                f.write('; EARLY STOP: {}\n'.format(self.result['early stop']))
             cur_time = datetime.now()
             self.summary.add_info('End Time', cur_time)
             self.summary.add_info('Duration', self.summary.current['End Time'] - self.summary.current['Start Time'])
             f.write('; END TIME: {}\n'.format(cur_time))
         self.result['received signal'] = received_signal
+        # early stop policies are not in the fingerprint, truncated results must not be reused
+        if (fingerprint is not None and received_signal is None and not self.result['early stop']
+                and TLCOutputParser.is_finished(self.result)):
+            self.result_cache.put(fingerprint, {'result': self.result, 'row': self.summary.current,
+                                                'model dir': os.getcwd()})
+        self.add_run_history(combination)
         return self.result
 
+    def add_run_history(self, combination=None):
+        """record the task in the run history database (if it is enabled)"""
+        if not self.run_history:
+            return
+        try:
+            self.run_history.add(
+                os.path.basename(self.cfg.get('options', 'target')).replace('.tla', ''),
+                self.cfg.get('options', 'model name'), os.getcwd(), combination, self.config_str,
+                self._tlc_cmd + self.options, self.classpath, self.result, self.summary.current,
+                self.progress.series or ())
+        except sqlite3.Error as e:
+            eprint('Warning: failed to record run history:', e)
+
+    def is_cacheable(self):
+        """runs are cacheable if they are reproducible"""
+        opt = self.cfg['options']
+        if self.distributed_mode or opt.get('recover'):
+            return False
+        return not self.simulation_mode or opt.get('simulation seed') is not None
+
+    def load_cached_result(self, fingerprint, cached):
+        """reuse the cached result, summary row and log"""
+        self.result = cached['result']
+        for k, v in cached['row'].items():
+            if k != 'No.':
+                self.summary.current[k] = v
+        self.summary.add_info('Cached From', os.path.basename(cached['model dir']), force=True)
+        cached_log = os.path.join(cached['model dir'], self.default_mc_log)
+        if os.path.isfile(cached_log) and cached['model dir'] != os.getcwd():
+            with open(cached_log) as f:
+                if self.streaming:
+                    if self.log_file:
+                        copyfileobj(f, self.log_file)
+                else:
+                    self.log_lines = f.readlines()
+                    if self.log_file:
+                        self.log_file.writelines(self.log_lines)
+            if self.log_file:
+                self.log_file.flush()
+        with open(self.default_mc_ini, 'a') as f:
+            f.write('\n; CACHED: {}\n; FROM: {}\n'.format(fingerprint, cached['model dir']))
+        xprint('Reusing cached result of', cached['model dir'])
+
     def get_log(self):
+        """get tlc output lines (in streaming mode, an iterator reading back from the log file)"""
+        if self.streaming:
+            return self._read_log()
         return self.log_lines
 
+    def _read_log(self):
+        if not self.log_path:
+            return
+        if self.log_file:
+            self.log_file.flush()
+        with open(self.log_path) as f:
+            yield from f
+
     def get_summary(self):
         return self.summary
 
@@ -1145,17 +2656,22 @@ class TLCWrapper:
         """save tlc output to file"""
         if filename is None:
             filename = self.default_mc_log
+        if self.streaming and self.log_path and os.path.realpath(filename) == self.log_path:
+            self.log_file.flush()
+            return
         with open(filename, 'w') as f:
-            f.writelines(self.log_lines)
+            f.writelines(self.get_log())
 
     def save_coverage(self, filename=None):
-        """save coverage msg to file if it has coverage msgs"""
+        """save coverage msg to file if it has coverage msgs, append the parsed snapshot and save its hotspots"""
         if filename is None:
             filename = self.default_mc_coverage
         if len(self.result['coverage']) != 0:
             with open(filename, 'w') as f:
                 f.write('\n'.join(self.result['coverage']))
                 f.write('\n')
+            if self.coverage.add_snapshot(self.result['coverage']):
+                self.coverage.save(self.default_mc_coverage_jsonl, self.default_mc_coverage_hotspots)
 
     def print_result(self):
         for _, msg in self.result['warnings']:
@@ -1169,63 +2685,919 @@ class TLCWrapper:
             for _, msg in self.result['error trace']:
                 xprint(msg)
         xprint('Status: errors: {}, warnings: {}, exit_state: {}'.format(
-            len(self.result['errors']), len(self.result['warnings']), self.result['exit state']))
+            self.result['message counts']['errors'], self.result['message counts']['warnings'],
+            self.result['exit state']))
 
     def has_error(self):
-        """check if there are errors in the result"""
-        return len(self.result['errors']) > 0 or self.result['exit state'] != 0
+        """check if there are errors in the result (early stop is not an error)"""
+        if self.result['early stop']:
+            return self.result['message counts']['errors'] > 0
+        return self.result['message counts']['errors'] > 0 or self.result['exit state'] != 0
 
 
-def main(config_file, summary_file=None, separate_constants=None, classpath='', need_community_modules=False,
-         log_output=False, stop_on_error=False, suppress_error_trace=False):
-    summary = Summary()
-    options = tuple()
-    wrapper_opts_read = False
-    no_summary = False
-    for options, config_stringio in BatchConfig(config_file, summary).get():
+class ScalingPredictor:
+    """Extrapolate distinct states, duration, disk and memory of combinations from finished ones
+
+    Growth curves are fitted over rows whose non-sized options are the same as the combination's:
+    exponential (log y = a + sum b_i * size_i) or power law (log y = a + sum b_i * log size_i) in the sizes of the
+    set/range options, the model with the smaller squared error in log space is used.
+    """
+
+    # summary column -> budget option ("budget <name>")
+    metrics = OrderedDict([('Distinct States', 'states'), ('Duration', 'seconds'),
+                           ('Peak States MB'.title(), 'disk mb'), ('Peak RSS MB'.title(), 'memory mb'),
+                           ('Peak Queue Size', 'queue')])
+
+    def __init__(self, rows=(), budget=None):
+        """rows are summary rows (of this batch or history), budget is {budget name: limit}"""
+        self.rows = []
+        self.budget = budget or {}
+        for row in rows:
+            self.add(row)
+
+    @classmethod
+    def from_config(cls, cfg):
+        budget = OrderedDict()
+        for name in cls.metrics.values():
+            value = cfg.getfloat('wrapper', 'budget ' + name, fallback=None)
+            if value is not None:
+                budget[name] = value
+        if not budget and not cfg.getboolean('wrapper', 'predict', fallback=False):
+            return None
+        return cls(budget=budget)
+
+    @staticmethod
+    def _to_number(value):
+        if isinstance(value, timedelta):
+            return value.total_seconds()
+        if isinstance(value, (int, float)) or value is None:
+            return value
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        duration_match = re.match(r'^(\d+):(\d\d):(\d\d(?:\.\d+)?)$', value)
+        if duration_match:
+            h, m, sec = duration_match.groups()
+            return int(h) * 3600 + int(m) * 60 + float(sec)
+        return None
+
+    def add(self, row):
+        """add a finished row, rows stopped early, bounded, failed or skipped are ignored"""
+        if row.get('Pruned By') or row.get('Over Budget') or row.get('Cached From'):
+            return
+        if not BatchConfig.is_complete_row(row):
+            return
+        if self._to_number(row.get('Distinct States')) is None:
+            return
+        self.rows.append(row)
+
+    def _get_points(self, comb):
+        """[(sizes, row)] of rows with the same non-sized options as comb"""
+        points = []
+        for row in self.rows:
+            sizes = []
+            for option in comb:
+                opt, value = BatchConfig._get_summary_option(option)
+                row_value = row.get(opt.title())
+                if row_value is None:
+                    break
+                size = BatchConfig.get_value_size(option)
+                if size is None:
+                    if str(row_value) != value:
+                        break
+                    continue
+                row_size = BatchConfig.get_value_size('{}: {}'.format(opt, row_value))
+                if row_size is None:
+                    break
+                sizes.append(row_size)
+            else:
+                points.append((sizes, row))
+        return points
+
+    @staticmethod
+    def _solve(xs, ys):
+        """least squares coefficients [a, b_1, ...] of y = a + sum b_i * x_i, or None"""
+        k = len(xs[0]) + 1
+        if len(xs) < k:
+            return None
+        rows = [[1.0] + list(x) for x in xs]
+        # normal equations, Gauss-Jordan elimination with partial pivoting
+        m = [[sum(r[i] * r[j] for r in rows) for j in range(k)] + [sum(r[i] * y for r, y in zip(rows, ys))]
+             for i in range(k)]
+        for col in range(k):
+            pivot = max(range(col, k), key=lambda r: abs(m[r][col]))
+            if abs(m[pivot][col]) < 1e-12:
+                return None
+            m[col], m[pivot] = m[pivot], m[col]
+            for r in range(k):
+                if r != col:
+                    f = m[r][col] / m[col][col]
+                    m[r] = [a - f * b for a, b in zip(m[r], m[col])]
+        return [m[i][k] / m[i][i] for i in range(k)]
+
+    @classmethod
+    def _fit_predict(cls, xs, ys, x):
+        """fit exponential and power law models of positive ys, predict y at x with the better one"""
+        from math import log, exp
+        logs = [log(y) for y in ys]
+        best = None
+        for transform in (lambda v: v, lambda v: log(v) if v > 0 else 0.0):  # exponential, power law
+            txs = [[transform(v) for v in i] for i in xs]
+            coef = cls._solve(txs, logs)
+            if coef is None:
+                continue
+            error = sum((coef[0] + sum(b * v for b, v in zip(coef[1:], tx)) - ly) ** 2 for tx, ly in zip(txs, logs))
+            if best is None or error < best[0] - 1e-9:
+                best = error, coef, transform
+        if best is None:
+            return None
+        _, coef, transform = best
+        return exp(min(coef[0] + sum(b * transform(v) for b, v in zip(coef[1:], x)), 700))
+
+    def predict(self, comb):
+        """{summary column: estimate} of comb, values of finished rows are returned as they are"""
+        sizes = [BatchConfig.get_value_size(i) for i in comb]
+        sizes = [i for i in sizes if i is not None]
+        points = self._get_points(comb)
+        prediction = OrderedDict()
+        for column in self.metrics:
+            data = [(x, self._to_number(row.get(column))) for x, row in points]
+            data = [(x, y) for x, y in data if y is not None and y > 0]
+            exact = [y for x, y in data if x == sizes]
+            if exact:
+                prediction[column] = exact[-1]
+                continue
+            # sizes that do not vary among the points cannot be extrapolated
+            varying = [i for i in range(len(sizes)) if len({x[i] for x, _ in data}) > 1]
+            if not data or any(i not in varying and data[0][0][i] != sizes[i] for i in range(len(sizes))):
+                continue
+            estimate = self._fit_predict([[x[i] for i in varying] for x, _ in data], [y for _, y in data],
+                                         [sizes[i] for i in varying])
+            if estimate is not None:
+                prediction[column] = estimate
+        return prediction
+
+    def check_budget(self, prediction):
+        """reason if the prediction exceeds the budget, or None"""
+        for column, name in self.metrics.items():
+            if name in self.budget and prediction.get(column) is not None and prediction[column] > self.budget[name]:
+                return '{} {:.0f} > {:g}'.format(name, prediction[column], self.budget[name])
+        return None
+
+    @staticmethod
+    def format(prediction):
+        return ', '.join('{}: {:.6g}'.format(k, v) for k, v in prediction.items())
+
+
+class MemorySizer:
+    """Size the fingerprint set and JVM memory of a combination from its expected distinct states and peak queue
+
+    The fingerprint set (OffHeapDiskFPSet) lives in direct memory, the rest of TLC in the heap. The state queue is kept
+    in the heap if it fits within the memory limit, otherwise on disk. A fingerprint set beyond the limit spills to disk.
+    """
+
+    fingerprint_bytes = 8
+    fingerprint_load = 0.5  # the open addressing table is kept at most half full
+    queued_state_bytes = 256  # heap used by a state of an in-memory queue
+    min_heap_mb = 512
+    min_direct_mb = 64
+    direct_reserve_mb = 32  # direct memory not used by the fingerprint set (-fpmem)
+
+    def __init__(self, limit_mb=None, workers=1):
+        """limit_mb is the memory limit (MB) of the JVM, or None"""
+        self.limit_mb = limit_mb or None
+        self.workers = workers
+
+    @classmethod
+    def from_config(cls, opt):
+        """sizer of a task from its [options] "memory ratio"/"system memory" and "workers" """
+        limit = 0
+        mem_ratio = opt.getfloat('memory ratio', fallback=None)
+        if mem_ratio:
+            limit = int(ParallelScheduler.get_total_memory() * mem_ratio)
+        if not limit:
+            limit = opt.getint('system memory', fallback=0)
+        workers = opt.get('workers', '1').strip()
+        workers = (os.cpu_count() or 1) if workers == 'auto' else max(int(workers), 1)
+        return cls(limit, workers)
+
+    def size(self, distinct_states, peak_queue=None):
+        """options override ("system memory", "heap ratio", "fpmem", "fpbits", "state queue") of the estimates"""
+        from math import ceil, floor, log2
+        fpset_mb = distinct_states * self.fingerprint_bytes / self.fingerprint_load / 2 ** 20
+        fpset_mb = max(self.min_direct_mb, 2 ** ceil(log2(fpset_mb)) if fpset_mb > 1 else 1)
+        direct_mb = fpset_mb + self.direct_reserve_mb
+        heap_mb = self.min_heap_mb
+        queue_mb = ceil(peak_queue * self.queued_state_bytes / 2 ** 20) if peak_queue else None
+        # the fingerprint set comes first, the disk queue is read and written sequentially
+        in_memory_queue = queue_mb is not None and (not self.limit_mb or heap_mb + queue_mb + direct_mb <= self.limit_mb)
+        if in_memory_queue:
+            heap_mb += queue_mb
+        if self.limit_mb and heap_mb + direct_mb > self.limit_mb:
+            direct_mb = max(self.limit_mb - heap_mb, self.min_direct_mb)
+        total_mb = heap_mb + direct_mb
+        return OrderedDict([
+            ('memory ratio', 0), ('system memory', total_mb), ('heap ratio', round(heap_mb / total_mb, 3)),
+            ('fpmem', floor(min(fpset_mb, direct_mb - self.direct_reserve_mb) / direct_mb * 100) / 100),
+            # nested fingerprint sets spread the contention of many workers
+            ('fpbits', max(1, ceil(log2(self.workers)))),
+            ('state queue', 'memory' if in_memory_queue else 'disk')])
+
+
+class BatchJournal:
+    """Journal of finished batch tasks (json lines, written after each task), to resume a killed batch"""
+
+    default_journal_prefix = 'MC_journal_'
+
+    def __init__(self, filename, resume=False):
+        """the journal is read if resume is True, otherwise it is truncated"""
+        self.filename = filename
+        self.header = {}
+        self.entries = []
+        if resume:
+            self.read()
+        else:
+            self.header = {'start time': str(datetime.now())}
+            with open(filename, 'w') as f:
+                f.write(json.dumps(self.header) + '\n')
+
+    def read(self):
+        try:
+            with open(self.filename) as f:
+                lines = f.readlines()
+        except OSError as e:
+            eprint('Warning: failed to read journal "{}": {}'.format(self.filename, e))
+            return
+        for no, line in enumerate(lines):
+            try:
+                entry = json.loads(line, object_pairs_hook=OrderedDict)
+            except ValueError:  # e.g. the last line written when the wrapper was killed
+                eprint('Warning: ignoring broken journal line {}'.format(no + 1))
+                continue
+            if 'combination' in entry:
+                entry['combination'] = tuple(entry['combination'])
+                self.entries.append(entry)
+            else:
+                self.header.update(entry)
+
+    def set_header(self, **kwargs):
+        self.header.update(kwargs)
+        self._append(kwargs)
+
+    def add(self, options, row, model_dir=None, has_error=False, violated=False):
+        """record a finished task: combination, model dir, summary row, exit status"""
+        entry = OrderedDict([('combination', list(options)), ('model dir', model_dir),
+                             ('exit status', row.get('Exit Status')), ('has error', has_error),
+                             ('violated', violated), ('row', row)])
+        self._append(entry)
+        entry['combination'] = tuple(options)
+        self.entries.append(entry)
+
+    def _append(self, entry):
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(entry, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def get_done(self):
+        """combinations already done"""
+        return {i['combination'] for i in self.entries}
+
+
+class ParallelScheduler:
+    """Admit parallel batch tasks while their workers and memory reservations fit the machine budget"""
+
+    def __init__(self, cores=None, memory=None):
+        self.total_memory = self.get_total_memory()
+        self.cores = cores if cores else (os.cpu_count() or 1)
+        self.memory = memory if memory is not None else self.total_memory  # MB, 0 means unlimited
+        self.used_cores = 0
+        self.used_memory = 0
+        self.running = 0
+
+    @staticmethod
+    def get_total_memory():
+        """physical memory (MB)"""
+        try:
+            from psutil import virtual_memory
+            return int(virtual_memory().total / 1024 / 1024)
+        except ImportError:
+            pass
+        try:
+            return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 / 1024)
+        except (ValueError, OSError, AttributeError):
+            return 0
+
+    def reservation(self, config_str, options_override=None):
+        """get (cores, memory) a task reserves, from its "workers" and "memory ratio"/"system memory" options"""
+        cfg = read_config(StringIO(config_str))[0]
+        for k, v in (options_override or {}).items():
+            cfg.set('options', k, str(v))
+        opt = cfg['options']
+        workers = opt.get('workers', '1').strip()
+        cores = self.cores if workers == 'auto' else max(int(workers), 1)
+        memory = 0
+        mem_ratio = opt.getfloat('memory ratio')
+        if mem_ratio:
+            memory = int(self.total_memory * mem_ratio)
+        if not memory:
+            memory = opt.getint('system memory', fallback=0)
+        return cores, memory
+
+    def acquire(self, cores, memory):
+        """reserve resources if they fit (a task always fits if nothing is running)"""
+        if self.running:
+            if self.used_cores + cores > self.cores:
+                return False
+            if self.memory and self.used_memory + memory > self.memory:
+                return False
+        self.used_cores += cores
+        self.used_memory += memory
+        self.running += 1
+        return True
+
+    def release(self, cores, memory):
+        self.used_cores -= cores
+        self.used_memory -= memory
+        self.running -= 1
+
+
+class Calibrator:
+    """Tune workers, GC and heap ratio by short "stop after" bounded probes of the first combination
+
+    Options are tuned one after another (workers, then gc, then heap ratio), keeping the best value found so far.
+    The throughput of a probe is distinct states found per second of model checking.
+    """
+
+    default_seconds = 60
+    default_gcs = 'ParallelGC, G1GC'
+    default_heap_ratios = '0.25, 0.33, 0.5'
+
+    def __init__(self, batch, task_kwargs):
+        self.config_str = batch.get_config_str()
+        self.cfg = read_config(StringIO(self.config_str))[0]
+        self.swept = batch.get_swept_options()
+        self.task_kwargs = dict(task_kwargs)
+        self.summary = Summary()
+
+    def _get_list(self, name, default):
+        return [i.strip() for i in self.cfg.get('wrapper', 'calibrate ' + name, fallback=default).split(',')
+                if i.strip()]
+
+    def get_candidates(self):
+        """yield (option, candidate values), options swept by the batch are not tuned"""
+        cores = os.cpu_count() or 1
+        workers = [str(2 ** i) for i in range(cores.bit_length()) if 2 ** i < cores] + [str(cores)]
+        yield 'workers', self._get_list('workers', ', '.join(workers))
+        yield 'gc', self._get_list('gc', self.default_gcs)
+        opt = self.cfg['options']
+        if opt.get('system memory') or opt.get('memory ratio'):
+            yield 'heap ratio', self._get_list('heap ratio', self.default_heap_ratios)
+
+    def probe(self, override):
+        """run a probe, return distinct states/s"""
+        seconds = self.cfg.getint('wrapper', 'calibrate seconds', fallback=self.default_seconds)
+        probe_override = dict(override)
+        probe_override['stop after'] = seconds
+        probe_override['model name'] = self.cfg.get('options', 'model name') + '_calibration'
+        for i in override:
+            self.summary.add_info(i, override[i], force=True)
         xprint('\n{}'.format('#' * 16))
-        tlc = TLCWrapper(config_stringio, summary=summary, gen_tla_constants_fn=separate_constants,
-            classpath=classpath, need_community_modules=need_community_modules, log_output=log_output,
-            suppress_error_trace=suppress_error_trace)
-        # check wrapper options from config file (only need to read once)
-        if not wrapper_opts_read:
-            wrapper_opts_read = True
-            if not stop_on_error:
-                stop_on_error = tlc.cfg.getboolean('wrapper', 'stop on error', fallback=False)
-            if not no_summary:
-                no_summary = tlc.cfg.getboolean('wrapper', 'no summary', fallback=False)
-            if not suppress_error_trace:
-                suppress_error_trace = tlc.cfg.getboolean('wrapper', 'suppress error trace', fallback=False)
-        if options:
-            xprint('Options:')
-            for i in options:
-                xprint(' ', i.replace('\n', '\n  '))
-            xprint('-' * 16)
+        xprint('Calibration probe:', ', '.join('{}: {}'.format(k, v) for k, v in override.items()))
+        task_kwargs = dict(self.task_kwargs, options_override=probe_override, record_history=False)
+        tlc = TLCWrapper(StringIO(self.config_str), summary=self.summary, **task_kwargs)
         result = tlc.run()
-        xprint('-' * 16)
-        tlc.print_result()
-        has_error = tlc.has_error()
-        summary.finish_current()
         del tlc
+        rate = 0
+        if result['distinct states'] and result['time consuming'] and result['time consuming'].total_seconds() > 0:
+            rate = result['distinct states'] / result['time consuming'].total_seconds()
+        self.summary.add_info('Distinct/Sec', round(rate, 1), force=True)
+        self.summary.finish_current()
+        return rate, result['received signal']
+
+    def run(self):
+        """run probes, return the best options"""
+        best = OrderedDict()
+        for name, candidates in self.get_candidates():
+            if name in self.swept or len(candidates) <= 1:
+                if candidates and name not in self.swept:
+                    best[name] = candidates[0]
+                continue
+            best_rate = -1
+            for value in candidates:
+                rate, received_signal = self.probe(OrderedDict(best, **{name: value}))
+                if rate > best_rate:
+                    best_rate, best[name] = rate, value
+                if received_signal == signal.SIGQUIT:
+                    xprint('Stopping calibration due to SIGQUIT (Ctrl+\\)')
+                    return best
+        xprint('=' * 16)
+        xprint(self.summary)
+        xprint('Calibrated options:', ', '.join('{}: {}'.format(k, v) for k, v in best.items()))
+        return best
+
+    @staticmethod
+    def write_config(config_lines, best, filename):
+        """write config with the [options] values replaced by (or, if not present, added with) the best values"""
+        with open(filename, 'w') as f:
+            f.writelines(set_config_values(config_lines, 'options', best))
+
+
+def set_config_values(config_lines, section_name, values):
+    """get config lines with the values of a section replaced (or, if not present, added), the section is
+    appended if it does not exist"""
+    lines = []
+    section = None
+    written = set()
+    skip_continuation = False
+    for line in config_lines:
+        if skip_continuation and line[:1] in ' \t' and line.strip():
+            continue
+        skip_continuation = False
+        if line.startswith('['):
+            section = line[1:line.find(']')].strip()
+            lines.append(line)
+            if section == section_name:
+                for k, v in values.items():
+                    lines.append('{}: {}\n'.format(k, v))
+                    written.add(k)
+            continue
+        name = line.split(':', 1)[0].strip()
+        if section == section_name and ':' in line and line[:1] not in ' \t;#' and name in written:
+            skip_continuation = True
+            continue
+        lines.append(line)
+    if not written and values:
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        lines.append('\n[{}]\n'.format(section_name))
+        lines += ['{}: {}\n'.format(k, v) for k, v in values.items()]
+    return lines
+
+
+class ParameterSearch:
+    """Find the largest value of a constant (a number, a..n range or {p1, ..., pn} set) whose model checking
+    completes within a time/memory/state budget, by exponential then binary probing
+
+    Probes are bounded by "stop after" (the time budget). A probe completes if TLC finished with an empty queue,
+    no errors, and within the state/memory budget.
+    """
+
+    default_seconds = 3600
+
+    def __init__(self, batch, constant, task_kwargs):
+        self.config_lines = batch.get_config_str().splitlines(True)
+        self.cfg = read_config(StringIO(batch.get_config_str()))[0]
+        self.constant = constant
+        if not self.cfg.has_option('constants', constant):
+            raise ValueError('constant "{}" is not in the [constants] section'.format(constant))
+        self.value = self.cfg.get('constants', constant)
+        self.seconds = self.cfg.getint('wrapper', 'search seconds', fallback=self.default_seconds)
+        self.states = self.cfg.getint('wrapper', 'search states', fallback=None)
+        self.memory = self.cfg.getint('wrapper', 'search memory mb', fallback=None)
+        self.min = self.cfg.getint('wrapper', 'search min', fallback=1)
+        self.max = self.cfg.getint('wrapper', 'search max', fallback=None)
+        self.task_kwargs = dict(task_kwargs)
+        self.summary = Summary()
+        self.results = OrderedDict()  # size -> completed
+        self.get_instance(1)  # check the value can be resized
+
+    def get_instance(self, n):
+        """the constant value of size n: "n", "a..n", or "{p1, ..., pn}" (prefixes like [model value] are kept)"""
+        match = re.match(r'^(.*?)(-?\d+)$', self.value.strip())
+        if match and '{' not in self.value:  # number or range
+            return match.group(1) + str(n)
+        match = re.match(r'^(.*{)\s*([^,}]*?)\d+\s*[,}]', self.value)
+        if not match:
+            raise ValueError('cannot resize "{}", it should be a number, a range or a set like {{p1, p2}}'.format(
+                self.value))
+        return '{}{}}}'.format(match.group(1), ', '.join('{}{}'.format(match.group(2), i) for i in range(1, n + 1)))
+
+    def probe(self, n):
+        """run the model of size n, return if it completes within the budget"""
+        if n in self.results:
+            return self.results[n]
+        value = self.get_instance(n)
+        lines = set_config_values(self.config_lines, 'constants', {self.constant: value})
+        lines = set_config_values(lines, 'options', {'stop after': self.seconds})
+        if self.memory:
+            lines = set_config_values(lines, 'wrapper', {'resource sampling': 'true'})
+        self.summary.add_option(self.constant, value)
+        xprint('\n{}'.format('#' * 16))
+        xprint('Search probe: {}: {}'.format(self.constant, value))
+        tlc = TLCWrapper(StringIO(''.join(lines)), summary=self.summary, record_history=False, **self.task_kwargs)
+        result = tlc.run(combination='{}: {}'.format(self.constant, value))
+        del tlc
+        row = self.summary.current
+        reason = None
+        if result['finish time'] is None or result['queued states'] != 0:
+            reason = 'not finished in {}s'.format(self.seconds)
+        elif result['message counts']['errors']:
+            reason = 'errors'
+        elif self.states is not None and (result['distinct states'] or 0) > self.states:
+            reason = 'states {} > {}'.format(result['distinct states'], self.states)
+        elif self.memory is not None and (row.get('Peak RSS MB'.title()) or 0) > self.memory:
+            reason = 'memory {} MB > {}'.format(row.get('Peak RSS MB'.title()), self.memory)
+        self.summary.add_info('Completed', 'yes' if reason is None else 'no: ' + reason, force=True)
+        self.summary.finish_current()
+        self.results[n] = reason is None
         if result['received signal'] == signal.SIGQUIT:
-            xprint('Stopping due to SIGQUIT (Ctrl+\\)')
-            break
-        if stop_on_error and has_error:
-            xprint('Stopping due to error (stop on error is enabled)')
-            break
-    xprint('=' * 16)
-    xprint(summary)
-    # summary_file=False means no summary (from -s flag), no_summary from config file
-    if summary_file is False or no_summary:
+            raise KeyboardInterrupt
+        return reason is None
+
+    def run(self):
+        """return the largest size that completes, or None"""
+        best, failed = None, None
+        n = self.min
+        try:
+            # exponential probing, up to max
+            while failed is None:
+                if self.max is not None and n >= self.max:
+                    n = self.max
+                if self.probe(n):
+                    best = n
+                else:
+                    failed = n
+                if n == self.max:
+                    break
+                n = max(n * 2, n + 1)
+            # binary probing between the largest completed and the smallest failed size
+            while best is not None and failed is not None and failed - best > 1:
+                mid = (best + failed) // 2
+                if self.probe(mid):
+                    best = mid
+                else:
+                    failed = mid
+        except KeyboardInterrupt:
+            xprint('Stopping search due to SIGQUIT (Ctrl+\\)')
+        return best
+
+    def report(self, best):
+        xprint('=' * 16)
+        xprint(self.summary)
+        if best is None:
+            xprint('No instance of {} completes within the budget'.format(self.constant))
+        else:
+            xprint('Largest instance within the budget: {}: {}'.format(self.constant, self.get_instance(best)))
+
+
+def run_task(options, config_stringio, summary, **kwargs):
+    """run a batch task, return (result, has_error, model dir)"""
+    xprint('\n{}'.format('#' * 16))
+    tlc = TLCWrapper(config_stringio, summary=summary, **kwargs)
+    if options:
+        xprint('Options:')
+        for i in options:
+            xprint(' ', i.replace('\n', '\n  '))
+        xprint('-' * 16)
+    combination = '; '.join(i.replace('\n', ' ') for i in options)
+    result = tlc.run(metrics_labels={'combination': combination}, combination=combination)
+    xprint('-' * 16)
+    tlc.print_result()
+    has_error = tlc.has_error()
+    model_dir = tlc.model_dir
+    summary.finish_current()
+    del tlc
+    return result, has_error, model_dir
+
+
+def _init_parallel_task(is_debug):
+    global debug
+    debug = is_debug
+    # signals are handled by TLCWrapper.run while a task is running
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGQUIT, signal.SIG_IGN)
+
+
+def _run_parallel_task(no, options, config_str, task_kwargs):
+    """run a batch task in a worker process, return (summary row, received signal, has error, violated, model dir)"""
+    global output_prefix
+    output_prefix = '[{}]'.format(no)
+    summary = Summary()
+    summary.new()
+    summary.current['No.'] = no
+    summary.add_options(options)
+    TLCWrapper.task_id_number = no - 1  # keep model dir names unique among worker processes
+    result, has_error, model_dir = run_task(options, StringIO(config_str), summary, **task_kwargs)
+    return (summary.current, result['received signal'], has_error, TLCOutputParser.is_invariant_violated(result),
+            model_dir)
+
+
+def add_skipped_task(summary, options, skip):
+    """skip a combination, skip is (summary column, value, reason)"""
+    column, value, reason = skip
+    xprint('\n{}'.format('#' * 16))
+    xprint('Skipping ({}):'.format(reason))
+    for i in options:
+        xprint(' ', i.replace('\n', '\n  '))
+    summary.add_info(column, value, force=True)
+    summary.finish_current()
+
+
+def run_parallel(batch, summary, task_kwargs, cores=None, memory=None, stop_on_error=False, get_skip=None,
+                 on_task_done=None, get_override=None):
+    """run batch tasks concurrently, Ctrl-\\ (SIGQUIT) stops admitting new tasks, Ctrl-C (SIGINT) stops the batch
+
+    get_skip(options) returns (summary column, value, reason) to skip a task, or None.
+    get_override(options, config_str) returns the options_override of a task (default is task_kwargs').
+    on_task_done(options, row, model_dir, has_error, is_violated) is called when a task finishes or is skipped
+    """
+    scheduler = ParallelScheduler(cores, memory)
+    if debug:
+        eprint('Debug: parallel budget: {} cores, {} MB memory'.format(scheduler.cores, scheduler.memory))
+    stopping = False
+
+    def stop(reason):
+        nonlocal stopping
+        if not stopping:
+            stopping = True
+            xprint('Stopping due to {}, waiting for running tasks'.format(reason))
+
+    def signal_handler(sig, frame):
+        if sig == signal.SIGQUIT:  # running tasks receive it as well
+            stop('SIGQUIT (Ctrl+\\)')
+
+    signal.signal(signal.SIGINT, signal.default_int_handler)  # raises KeyboardInterrupt
+    signal.signal(signal.SIGQUIT, signal_handler)
+
+    first_no = len(summary.batch) + 1  # after resumed tasks
+    tasks = deque((no, options, config_stringio.read())
+                  for no, (options, config_stringio) in enumerate(batch.get(), first_no))
+    running = {}
+
+    def finish(future):
+        need, options = running.pop(future)
+        scheduler.release(*need)
+        row, received_signal, has_error, is_violated, model_dir = future.result()
+        summary.insert(row)
+        if on_task_done and received_signal is None:  # interrupted tasks are run again on resume
+            on_task_done(options, row, model_dir, has_error, is_violated)
+        return received_signal, has_error
+
+    executor = ProcessPoolExecutor(max_workers=scheduler.cores, initializer=_init_parallel_task, initargs=(debug,))
+    try:
+        while True:
+            while tasks and not stopping:
+                skip = get_skip(tasks[0][1]) if get_skip else None
+                if skip is not None:
+                    no, options, _ = tasks.popleft()
+                    row = Summary()
+                    row.new()
+                    row.current['No.'] = no
+                    row.add_options(options)
+                    add_skipped_task(row, options, skip)
+                    summary.insert(row.current)
+                    if on_task_done:
+                        on_task_done(options, row.current, None, False, False)
+                    continue
+                override = get_override(*tasks[0][1:]) if get_override else task_kwargs.get('options_override')
+                need = scheduler.reservation(tasks[0][2], override)
+                if not scheduler.acquire(*need):
+                    break
+                task = tasks.popleft()
+                running[executor.submit(_run_parallel_task, *task, dict(task_kwargs, options_override=override))] = \
+                    need, task[1]
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                received_signal, has_error = finish(future)
+                if received_signal == signal.SIGQUIT:
+                    stop('SIGQUIT (Ctrl+\\)')
+                if stop_on_error and has_error:
+                    stop('error (stop on error is enabled)')
+    except KeyboardInterrupt:
+        xprint('Stopping due to SIGINT (Ctrl+C), interrupting running tasks')
+        # workers forward it to TLC, then tasks not started yet are cancelled and the running ones are waited for
+        for worker in active_children():
+            os.kill(worker.pid, signal.SIGINT)
+        executor.shutdown(cancel_futures=True)
+        for future in list(running):
+            if future.cancelled():
+                running.pop(future)
+            else:
+                finish(future)
+    finally:
+        executor.shutdown()
+
+
+def main(config_file, summary_file=None, separate_constants=None, classpath='', need_community_modules=False,
+         log_output=False, stop_on_error=False, suppress_error_trace=False, parallel=False, calibrate=None,
+         resume=False, search=None):
+    summary = Summary()
+    batch = BatchConfig(config_file)
+    # check wrapper options from config file
+    wrapper_cfg = batch.get_config()
+    if not stop_on_error:
+        stop_on_error = wrapper_cfg.getboolean('wrapper', 'stop on error', fallback=False)
+    no_summary = wrapper_cfg.getboolean('wrapper', 'no summary', fallback=False)
+    if not suppress_error_trace:
+        suppress_error_trace = wrapper_cfg.getboolean('wrapper', 'suppress error trace', fallback=False)
+    if not parallel:
+        parallel = wrapper_cfg.getboolean('wrapper', 'parallel', fallback=False)
+    task_kwargs = dict(gen_tla_constants_fn=separate_constants, classpath=classpath,
+                       need_community_modules=need_community_modules, log_output=log_output,
+                       suppress_error_trace=suppress_error_trace)
+    is_batch = len(batch.dup_option_info) != 0
+    if calibrate is None:
+        calibrate = get_boolean_or_value(wrapper_cfg, 'wrapper', 'calibrate', fallback=False)
+        if not isinstance(calibrate, bool):
+            calibrate = calibrate.lower()
+            if calibrate != 'apply':
+                raise ValueError('[wrapper] "calibrate" should be a boolean or apply')
+    if calibrate:
+        calibrator = Calibrator(batch, task_kwargs)
+        best = calibrator.run()
+        if summary_file is not False and not no_summary:
+            calibrator.summary.print_to_file('MC_calibration_{}_{}.csv'.format(
+                wrapper_cfg.get('options', 'model name'), datetime.now().strftime("%Y-%m-%d_%H-%M-%S")))
+        if not hasattr(config_file, 'read'):
+            calibrated_file = re.sub(r'(\.ini)?$', '_calibrated.ini', config_file, count=1)
+            Calibrator.write_config(batch.cfg_lines, best, calibrated_file)
+            xprint('Calibrated config file:', calibrated_file)
+        if calibrate != 'apply':
+            return
+        task_kwargs['options_override'] = best
+    if search is None:
+        search = wrapper_cfg.get('wrapper', 'search constant', fallback=None)
+    if search:
+        parameter_search = ParameterSearch(batch, search, task_kwargs)
+        parameter_search.report(parameter_search.run())
+        if summary_file is not False and not no_summary:
+            parameter_search.summary.print_to_file('MC_search_{}_{}.csv'.format(
+                search, datetime.now().strftime("%Y-%m-%d_%H-%M-%S")))
         return
-    if summary_file or (summary_file is None and options):
+    batch_order = wrapper_cfg.get('wrapper', 'batch order', fallback='ini').lower()
+    if batch_order not in {'ini', 'cost'}:
+        raise ValueError('[wrapper] "batch order" should be one of: ini, cost')
+    history = wrapper_cfg.get('wrapper', 'batch history', fallback='').split()
+    default_history = os.path.join(os.path.dirname(os.path.realpath(wrapper_cfg.get('options', 'target'))),
+                                   RunHistory.default_history_file)
+    if not history and os.path.isfile(default_history):
+        history = [default_history]
+    spec = os.path.basename(wrapper_cfg.get('options', 'target')).replace('.tla', '')
+    if batch_order == 'cost':
+        batch.sort_by_cost(BatchConfig.read_history(history, spec) if history else None)
+    prune = wrapper_cfg.getboolean('wrapper', 'prune dominated', fallback=False)
+    config_file_name = config_file if not hasattr(config_file, 'read') else 'stdin'
+    config_name = os.path.basename(config_file_name).replace('.ini', '')
+
+    # summary_file=False means no summary (from -s flag), no_summary from config file
+    summary_name = None
+    if summary_file is not False and not no_summary and (summary_file or (summary_file is None and is_batch)):
         if isinstance(summary_file, str):
-            name = summary_file
+            summary_name = summary_file
         else:
-            config_file_name = config_file if not hasattr(config_file, 'read') else 'stdin'
-            name = "MC_summary_{}_{}.csv".format(
-                os.path.basename(config_file_name).replace('.ini', ''), datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
-        summary.print_to_file(name)
+            summary_name = "MC_summary_{}_{}.csv".format(config_name, datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
+
+    # the journal records finished tasks, to resume the batch if the wrapper is killed
+    journal = None
+    violated = []  # (options, No.) of tasks that violated an invariant
+    journal_name = get_boolean_or_value(wrapper_cfg, 'wrapper', 'batch journal', fallback=True)
+    if is_batch and journal_name:
+        if journal_name is True:
+            journal_name = '{}{}.jsonl'.format(BatchJournal.default_journal_prefix, config_name)
+        journal = BatchJournal(journal_name, resume=resume)
+        if resume:
+            xprint('Resuming: {} tasks done in "{}"'.format(len(journal.entries), journal_name))
+            for entry in journal.entries:
+                summary.insert(OrderedDict(entry['row']))
+                if entry['violated']:
+                    violated.append((entry['combination'], entry['row']['No.']))
+            batch.skip = journal.get_done()
+            if summary_name and not isinstance(summary_file, str):
+                summary_name = journal.header.get('summary file', summary_name)
+        journal.set_header(config=os.path.realpath(config_file_name), **{'summary file': summary_name})
+    elif resume:
+        eprint('Warning: nothing to resume, batch journal is disabled or it is not a batch')
+
+    # skip combinations dominating violating ones, or predicted to exceed the budget
+    predictor = ScalingPredictor.from_config(wrapper_cfg)
+    memory_sizing = wrapper_cfg.get('options', 'memory sizing', fallback='false').lower() == 'auto'
+    if memory_sizing and predictor is None:
+        predictor = ScalingPredictor()
+    if predictor:
+        for row in chain(BatchConfig.read_history(history, spec) if history else [],
+                         (i['row'] for i in journal.entries) if journal and resume else []):
+            predictor.add(row)
+        predictions = [OrderedDict([('Options', '; '.join(options))], **predictor.predict(options))
+                       for options in batch.get_combinations() if options not in batch.skip]
+        if any(len(i) > 1 for i in predictions):
+            xprint('Predictions:')
+            PrintTable.print_table(predictions, OrderedDict((i, i) for i in ['Options'] + list(predictor.metrics)))
+
+    def get_skip(options):
+        if prune:
+            pruned_by = batch.find_dominated(options, violated)
+            if pruned_by is not None:
+                return 'Pruned By', pruned_by, 'dominates No. {} which violated an invariant'.format(pruned_by)
+        if predictor:
+            prediction = predictor.predict(options)
+            over_budget = predictor.check_budget(prediction)
+            if over_budget:
+                return 'Over Budget', over_budget, 'predicted ' + over_budget
+            if prediction:
+                xprint('Prediction:', ScalingPredictor.format(prediction))
+        return None
+
+    overrides = {}
+
+    def get_override(options, config_str):
+        """options override of a task, its memory is sized by its estimates if "memory sizing" is auto"""
+        override = task_kwargs.get('options_override')
+        if not memory_sizing:
+            return override
+        if tuple(options) not in overrides:
+            prediction = predictor.predict(options)
+            if prediction.get('Distinct States') is None:
+                xprint('Memory sizing: no estimate, using the configured memory')
+                overrides[tuple(options)] = override
+            else:
+                cfg = read_config(StringIO(config_str))[0]
+                for k, v in (override or {}).items():
+                    cfg.set('options', k, str(v))
+                sizing = MemorySizer.from_config(cfg['options']).size(prediction['Distinct States'],
+                                                                      prediction.get('Peak Queue Size'))
+                xprint('Memory sizing:', ', '.join('{}: {}'.format(k, v) for k, v in sizing.items()
+                                                   if k != 'memory ratio'))
+                overrides[tuple(options)] = dict(override or {}, **sizing)
+        return overrides[tuple(options)]
+
+    def on_task_done(options, row, model_dir=None, has_error=False, is_violated=False):
+        if is_violated:
+            violated.append((options, row['No.']))
+        if predictor:
+            predictor.add(row)
+        if journal:
+            journal.add(options, row, model_dir, has_error, is_violated)
+        if summary_name:
+            summary.print_to_file(summary_name)
+
+    if parallel:
+        run_parallel(batch, summary, task_kwargs, stop_on_error=stop_on_error, get_skip=get_skip,
+                     on_task_done=on_task_done, get_override=get_override,
+                     cores=wrapper_cfg.getint('wrapper', 'parallel cores', fallback=None),
+                     memory=wrapper_cfg.getint('wrapper', 'parallel memory', fallback=None))
+    else:
+        batch.summary = summary
+        for options, config_stringio in batch.get():
+            skip = get_skip(options)
+            if skip is not None:
+                add_skipped_task(summary, options, skip)
+                on_task_done(options, summary.current)
+                continue
+            result, has_error, model_dir = run_task(options, config_stringio, summary, **dict(
+                task_kwargs, options_override=get_override(options, config_stringio.getvalue())))
+            is_violated = TLCOutputParser.is_invariant_violated(result)
+            if result['received signal'] is None:  # interrupted tasks are run again on resume
+                on_task_done(options, summary.current, model_dir, has_error, is_violated)
+            if result['received signal'] == signal.SIGQUIT:
+                xprint('Stopping due to SIGQUIT (Ctrl+\\)')
+                break
+            if stop_on_error and has_error:
+                xprint('Stopping due to error (stop on error is enabled)')
+                break
+    xprint('=' * 16)
+    xprint(summary)
+    if summary_name:
+        summary.print_to_file(summary_name)
+
+
+def replay(log_files, summary_file=None):
+    """rebuild the summary table from existing TLC tool mode output files (e.g. archived MC.out)"""
+    summary = Summary()
+    for log_file in log_files:
+        summary.new()
+        summary.add_info('Log File', log_file, force=True)
+        try:
+            TLCOutputParser.parse_file(log_file).add_to_summary(summary)
+        except (OSError, ValueError, IndexError) as e:
+            eprint('Warning: failed to replay "{}": {}'.format(log_file, e))
+        summary.finish_current()
+    xprint(summary)
+    if summary_file is False:
+        return
+    if not isinstance(summary_file, str):
+        summary_file = 'MC_summary_replay_{}.csv'.format(datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
+    summary.print_to_file(summary_file)
+
+
+def query_history(history_file, spec=None, combination=None):
+    """print the throughput history of runs of spec whose combination contains the combination string"""
+    table = RunHistory(history_file).get_throughput(spec, combination)
+    if table:
+        PrintTable.print_table(table)
+
+
+def coverage_diff(old_file, new_file):
+    """print the changes of coverage counts/costs between two runs (MC_coverage.jsonl or MC.out files)"""
+    rows = CoverageProfile.load(old_file).diff(CoverageProfile.load(new_file))
+    if rows:
+        title = OrderedDict()
+        for row in rows:
+            title.update((k, k) for k in row)
+        PrintTable.print_table(rows, title)
 
 
 def raw_run(config_file, is_print_cmd=False, separate_constants=None, classpath='', need_community_modules=False):
@@ -1266,6 +3638,22 @@ if __name__ == '__main__':
                         help='Stop batch execution when TLC encounters errors', default=False)
     parser.add_argument('-t', dest='suppress_error_trace', action='store_true', required=False,
                         help='Suppress printing error traces', default=False)
+    parser.add_argument('-p', dest='parallel', action='store_true', required=False,
+                        help='Run batch tasks in parallel within the cores/memory budget', default=False)
+    parser.add_argument('-C', dest='calibrate', action='store_const', const=True, required=False,
+                        help='Calibrate workers/gc/heap ratio with short probes, write "*_calibrated.ini" and exit')
+    parser.add_argument('--resume', dest='resume', action='store_true', required=False, default=False,
+                        help='Resume a killed batch: skip tasks recorded in the batch journal and rebuild the summary')
+    parser.add_argument('--coverage-diff', dest='coverage_diff', metavar=('OLD', 'NEW'), nargs=2, required=False,
+                        help='Compare the coverage of two runs (MC_coverage.jsonl or MC.out) and exit')
+    parser.add_argument('--search', dest='search', metavar='CONSTANT', required=False,
+                        help='Find the largest value of CONSTANT that completes within the [wrapper] "search ..." '
+                             'budget and exit')
+    parser.add_argument('--history', dest='history', metavar=('DB', 'SPEC'), nargs='+', required=False,
+                        help='Print the throughput history in the run history database (of SPEC, and combinations '
+                             'containing the 3rd argument) and exit')
+    parser.add_argument('-R', dest='replay', metavar='MC.out', action='store', nargs='+', required=False,
+                        help='Rebuild the summary table from existing TLC output files and exit')
 
     args = parser.parse_args()
 
@@ -1278,6 +3666,15 @@ if __name__ == '__main__':
         exit(0)
     if args.no_debug:
         debug = False
+    if args.history:
+        query_history(*args.history[:3])
+        exit(0)
+    if args.coverage_diff:
+        coverage_diff(*args.coverage_diff)
+        exit(0)
+    if args.replay:
+        replay(args.replay, not args.no_summary)
+        exit(0)
     if not args.config_ini:
         args.config_ini = sys.stdin
     if args.get_cmd:
@@ -1289,4 +3686,5 @@ if __name__ == '__main__':
     else:
         main(args.config_ini, not args.no_summary, separate_constants=args.separate_constants,
             classpath=args.classpath, need_community_modules=args.community_modules, log_output=True,
-            stop_on_error=args.stop_on_error, suppress_error_trace=args.suppress_error_trace)
+            stop_on_error=args.stop_on_error, suppress_error_trace=args.suppress_error_trace, parallel=args.parallel,
+            calibrate=args.calibrate, resume=args.resume, search=args.search)
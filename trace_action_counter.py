@@ -157,7 +157,10 @@ if __name__ == '__main__':
     parser.add_argument('-p', dest='nproc', action='store', type=int, default=cpu_count(), help='Number of processes')
     parser.add_argument('-n', dest='ntrace', action='store', type=int, default=0, help='Print progress every n traces')
     parser.add_argument('-l', dest='logfile', action='store', help='Log output to file')
+    parser.add_argument('-v', dest='include', action='store', help='Keep only these variables (comma separated)')
+    parser.add_argument('-x', dest='exclude', action='store', help='Skip these variables (comma separated)')
     args = parser.parse_args()
+    tr.set_projection(args.include and args.include.split(','), args.exclude and args.exclude.split(','))
     process_man = ProgressManager(nproc=args.nproc, is_delete=args.remove, trace_dir=args.trace_dir,
                                   period_ntrace=args.ntrace, logfile=args.logfile)
     process_man.iterate_dir()
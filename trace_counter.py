@@ -110,9 +110,12 @@ if __name__ == '__main__':
     parser.add_argument('-p', dest='nproc', action='store', type=int, default=cpu_count(), help='Number of processes')
     parser.add_argument('-n', dest='ntrace', action='store', type=int, default=0, help='Print progress every n traces')
     parser.add_argument('-l', dest='logfile', action='store', help='Log output to file')
+    parser.add_argument('-v', dest='include', action='store', help='Keep only these variables (comma separated)')
+    parser.add_argument('-x', dest='exclude', action='store', help='Skip these variables (comma separated)')
     parser.add_argument('-f', dest='hashfile', action='store', help='Hash file')
     parser.add_argument('-r', dest='reduce', action='store_true', help='Reduce only')
     args = parser.parse_args()
+    tr.set_projection(args.include and args.include.split(','), args.exclude and args.exclude.split(','))
     if args.hashfile is None:
         args.hashfile = default_hash_filename
     if not args.reduce:
@@ -2,25 +2,44 @@
 
 # usage: python3 trace_reader.py -h
 
+import io
+import mmap
 import os
+import re
 import sys
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict, defaultdict, deque
+from collections.abc import MutableMapping
+from itertools import chain, islice
+from multiprocessing import cpu_count, get_context
 
 class TraceReader:
     LIST_IS_SEQ = "seq"
     LIST_IS_SET = "set"
+    OUT_START_MSG = 'The behavior up to this point is:'
+    OUT_END_MSGS = ['Progress', 'The number of states generated', 'Worker: rmi']
 
     def __init__(self, save_action_name=False, hashable=False, sort_dict=False,
-                 handler_py=None):
+                 handler_py=None, lazy=False, include=None, exclude=None):
         self._matching = {'{': ('}', self._braces), '<': ('$', self._chevrons),
             '[': (']', self._brackets), '(': (')', self._parentheses)}
+        self._closing = {v[0]: k for k, v in self._matching.items()}
+        # characters the parser stops at, others are skipped by one search
+        def chars_pat(chars):
+            return re.compile('[{}]'.format(re.escape(chars)))
+        self._bracket_pat = chars_pat(''.join(self._matching) + ''.join(self._closing))
+        self._list_pat = chars_pat(''.join(self._matching) + ',')
+        self._dict_pats = {(arrow, sep): chars_pat(''.join(self._matching) + arrow[0] + sep[0])
+                           for arrow, sep in (('|->', ','), (':>', '@@'))}
 
         self._string_dict = {"TRUE": True, "FALSE": False}
         self._user_dict = dict()
         self._kv_outside_handler = lambda k, v: (k, v)
+        self._kv_outside_handler_set = False  # it may rename variables
         self._kv_inside_handler = lambda k, v: (k, v)
         self._list_handler = lambda s, k: s
         self.set_handlers(handler_py)
+        self.lazy = lazy
+        self.set_projection(include, exclude)
         self.save_action_name = save_action_name
         self.sort_dict = sort_dict
         self.hashable = hashable
@@ -54,19 +73,17 @@ class TraceReader:
             self.set_kv_handler(handler_module.inside_kv_handler, inside=True)
 
 
-    # find '}$])' for '{<[('
-    def _find_next_match(self, string):
-        level = 0
-        char = string[0]
-        match_char = self._matching[char][0]
-        for i, c in enumerate(string):
-            if c == char:
-                level += 1
-            elif c == match_char:
-                level -= 1
-                if level == 0:
-                    return i
-        assert False
+    # find '}$])' for every '{<[(' in one pass, return {open index: close index}
+    def _match_brackets(self, string):
+        matches = dict()
+        stacks = {c: [] for c in self._matching}
+        for m in self._bracket_pat.finditer(string):
+            c = m.group()
+            if c in stacks:
+                stacks[c].append(m.start())
+            elif stacks[self._closing[c]]:
+                matches[stacks[self._closing[c]].pop()] = m.start()
+        return matches
 
 
     def _post_process_list(self, l, kind):
@@ -79,33 +96,36 @@ class TraceReader:
         return l
 
 
-    # return a list
-    def _lists(self, string, kind):
+    # return a list of string[start:end]
+    def _lists(self, string, matches, start, end, kind):
         l = list()
-        if not string:
+        if start == end:
             return self._post_process_list(l, kind)
-        processed, pos, length = 0, 0, len(string)
-        while pos < length:
-            if string[pos] in self._matching or string[pos] == ',':
-                if string[pos] != ',':
-                    pos = pos + self._find_next_match(string[pos:]) + 1
-                l.append(self._variable_converter(string[processed:pos]))
-                processed = pos + 2
-                pos += 1
-            pos += 1
+        processed, pos = start, start
+        while pos < end:
+            m = self._list_pat.search(string, pos, end)
+            if m is None:
+                pos = end
+                break
+            pos = m.start()
+            if string[pos] != ',':
+                pos = matches[pos] + 1
+            l.append(self._convert(string, matches, processed, pos))
+            processed = pos + 2
+            pos += 2
         if pos != processed:
-            l.append(self._variable_converter(string[processed:pos]))
+            l.append(self._convert(string, matches, processed, pos))
         return self._post_process_list(l, kind)
 
 
     # < string $
-    def _chevrons(self, string):
-        return self._lists(string, kind=self.LIST_IS_SEQ)
+    def _chevrons(self, string, matches, start, end):
+        return self._lists(string, matches, start, end, kind=self.LIST_IS_SEQ)
 
 
     # { string } (we treat set as list)
-    def _braces(self, string):
-        return self._lists(string, kind=self.LIST_IS_SET)
+    def _braces(self, string, matches, start, end):
+        return self._lists(string, matches, start, end, kind=self.LIST_IS_SET)
 
 
     # make dicts hashable if hash_data is True
@@ -124,49 +144,58 @@ class TraceReader:
             return d
 
 
-    # return a dict
-    def _dict_common(self, string, arrow, sep, value_seq_len):
+    # return a dict of string[start:end]
+    def _dict_common(self, string, matches, start, end, arrow, sep, value_seq_len):
         d = dict() if not self.hashable else self.HashableDict()
-        processed, pos, length = 0, 0, len(string)
-        key, value = '', ''
+        pat = self._dict_pats[(arrow, sep)]
+        processed, pos = start, start
+        key = ''
         while True:
             if string[pos] == arrow[0]:
                 key = string[processed:pos - 1]
                 pos += len(arrow)
                 processed = pos + 1
             if string[pos] == sep[0]:
-                value = string[processed:pos - value_seq_len]
+                value_end = pos - value_seq_len
                 pos += len(sep)
-                processed = pos + 1
                 key, value = self._kv_inside_handler(
-                    key, self._variable_converter(value))
+                    key, self._convert(string, matches, processed, value_end))
+                processed = pos + 1
                 d[key] = value
-            pos += 1
-            if pos >= length:
+            m = pat.search(string, pos + 1, end)
+            if m is None:
                 break
+            pos = m.start()
             if string[pos] in self._matching:
-                pos = pos + self._find_next_match(string[pos:])
-        value = string[processed:]
+                pos = matches[pos]
         key, value = self._kv_inside_handler(
-            key, self._variable_converter(value))
+            key, self._convert(string, matches, processed, end))
         d[key] = value
         return self._post_process_dict(d)
 
 
     # [ string ]
-    def _brackets(self, string):
-        return self._dict_common(string, '|->', ',', 0)
+    def _brackets(self, string, matches, start, end):
+        return self._dict_common(string, matches, start, end, '|->', ',', 0)
 
 
     # ( string )
-    def _parentheses(self, string):
-        return self._dict_common(string, ':>', '@@', 1)
-
-
-    # convert string to python variable
-    def _variable_converter(self, string):
-        if string[0] in self._matching:
-            return self._matching[string[0]][1](string[1:-1].strip())
+    def _parentheses(self, string, matches, start, end):
+        return self._dict_common(string, matches, start, end, ':>', '@@', 1)
+
+
+    # convert string[start:end] to python variable, matches are its brackets
+    def _convert(self, string, matches, start, end):
+        char = string[start] if start < end else ''
+        if char in self._matching:
+            # strip the brackets and the spaces inside
+            start, end = start + 1, end - 1
+            while start < end and string[start].isspace():
+                start += 1
+            while end > start and string[end - 1].isspace():
+                end -= 1
+            return self._matching[char][1](string, matches, start, end)
+        string = string[start:end]
         if string in self._user_dict:
             return self._user_dict[string]
         if string in self._string_dict:
@@ -179,6 +208,11 @@ class TraceReader:
             return string
 
 
+    # convert string to python variable
+    def _variable_converter(self, string):
+        return self._convert(string, self._match_brackets(string), 0, len(string))
+
+
     # callback handlers
     def set_user_dict(self, user_dict):
         self._user_dict = user_dict
@@ -189,12 +223,105 @@ class TraceReader:
             self._kv_inside_handler = kv_handler
         else:
             self._kv_outside_handler = kv_handler
+            self._kv_outside_handler_set = True
 
 
     def set_list_handler(self, list_handler):
         self._list_handler = list_handler
 
 
+    # keep only variables in include (if any) and not in exclude,
+    # other variables are never converted and are left out of states
+    def set_projection(self, include=None, exclude=None):
+        self.include = set(include) if include else None
+        self.exclude = set(exclude) if exclude else set()
+
+
+    def _is_projected(self, variable):
+        return variable not in self.exclude and (
+            self.include is None or variable in self.include)
+
+
+    # convert a variable of a state, return (key, value)
+    def _variable_decoder(self, k, v):
+        # replace to 1-char keywords, replace '>' to a uniq key
+        return self._kv_outside_handler(k, self._variable_converter(
+            v.replace('<<', '<').replace('>>', '$')))
+
+
+    # a state of lazy=True, variables are converted on first access
+    class LazyState(MutableMapping):
+        def __init__(self, reader, items, raw):
+            self._reader = reader
+            self._data = items  # converted items, e.g. '_action' and '_hash'
+            self._raw = raw  # variable -> value string, not converted yet
+            self._keys = list(items) + list(raw)
+
+        def _decode(self, k):
+            key, value = self._reader._variable_decoder(k, self._raw.pop(k))
+            if key != k:
+                self._keys[self._keys.index(k)] = key
+            self._data[key] = value
+            return key
+
+        def _decode_all(self):
+            for k in list(self._raw):
+                self._decode(k)
+
+        def __getitem__(self, key):
+            if key in self._data:
+                return self._data[key]
+            if key in self._raw and self._decode(key) == key:
+                return self._data[key]
+            if self._reader._kv_outside_handler_set:  # key may be renamed from another variable
+                for k in list(self._raw):
+                    if self._decode(k) == key:
+                        return self._data[key]
+            raise KeyError(key)
+
+        def __setitem__(self, key, value):
+            if key in self._raw:
+                del self._raw[key]
+            elif key not in self._data:
+                self._keys.append(key)
+            self._data[key] = value
+
+        def __delitem__(self, key):
+            if key not in self._data and key not in self._raw:
+                self[key]  # decode renamed variables or raise KeyError
+            self._data.pop(key, None)
+            self._raw.pop(key, None)
+            self._keys.remove(key)
+
+        def __contains__(self, key):
+            if key in self._data or key in self._raw and not self._reader._kv_outside_handler_set:
+                return True
+            return super().__contains__(key)
+
+        def __iter__(self):
+            if self._reader._kv_outside_handler_set:
+                self._decode_all()
+            keys = list(self._keys)
+            return iter(sorted(keys) if self._reader.sort_dict else keys)
+
+        def __len__(self):
+            if self._reader._kv_outside_handler_set:
+                self._decode_all()
+            return len(self._keys)
+
+        def __hash__(self):
+            return hash(frozenset(self.items()))
+
+        def __repr__(self):
+            return '{}({})'.format(type(self).__name__, self.decode())
+
+        # convert all variables, return the state as if lazy is False
+        def decode(self):
+            self._decode_all()
+            return self._reader._post_process_dict(
+                dict((k, self._data[k]) for k in self._keys))
+
+
     # convert MC.out to trace file
     @staticmethod
     def get_out_converted_string(file):
@@ -203,9 +330,7 @@ class TraceReader:
         else:
             f = file
 
-        n_state = 0
-        start_msg = 'The behavior up to this point is:'
-        end_msg = ['Progress', 'The number of states generated', 'Worker: rmi']
+        start_msg = TraceReader.OUT_START_MSG
         for line in f:
             if 'TLC Server' in line:
                 continue
@@ -216,6 +341,14 @@ class TraceReader:
             if line.startswith(start_msg):
                 yield '-' * 16 + ' MODULE MC_trace ' + '-' * 16 + '\n'
                 break
+        yield from TraceReader.get_out_trace_string(f)
+
+
+    # convert the trace part of MC.out (after "The behavior up to this point is:")
+    @staticmethod
+    def get_out_trace_string(f):
+        n_state = 0
+        end_msg = TraceReader.OUT_END_MSGS
         for line in f:
             if line[0] in '/ ':
                 yield line
@@ -302,48 +435,175 @@ class TraceReader:
             else:
                 return
 
+        yield from self._read_states(f, is_dot_file)
+        f.close()
+
+
+    # yield (state, state_str) of trace file lines, cur_action_line is the
+    # action line before the lines
+    def _read_states(self, f, is_dot_file, cur_action_line=None):
         state = dict()
-        variable = ""
+        raw = dict()  # unconverted variables if lazy
+        skipped = False  # the state has variables left out by the projection
+        variable = []  # stripped lines of the variable
         lines = []
         cur_action = None
-        cur_action_line = None
+        if cur_action_line is not None and self.save_action_name:
+            cur_action = self.get_action_name(cur_action_line)
         for line in f:
             if line.startswith(r'\*'):
                 cur_action_line = line
                 if self.save_action_name:
                     cur_action = self.get_action_name(line)
             elif line[0] in "-=S":
-                if state:
-                    state = self._post_process_dict(state)
+                if state or raw or skipped:
+                    if self.lazy:
+                        state = self.LazyState(self, state, raw)
+                        raw = dict()
+                    else:
+                        state = self._post_process_dict(state)
                     yield state, ''.join(lines).strip()
                     state = dict()
+                    skipped = False
                 if cur_action is not None:
                     state['_action'] = cur_action
                 if is_dot_file and line[0] == 'S':
                     state['_hash'] = int(line[6:-4])
                 lines = [] if cur_action_line is None else [cur_action_line]
             elif line[0] in "/\n":
-                if variable:
-                    k, v = variable.split('=')
+                if variable and any(variable):
+                    k, v = ' '.join(variable).split('=')
                     k, v = k.rstrip(), v.lstrip()
-                    # replace to 1-char keywords, replace '>' to a uniq key
-                    k, v = self._kv_outside_handler(k, self._variable_converter(
-                        v.replace('<<', '<').replace('>>', '$')))
-                    state[k] = v
-                variable = line.strip()[3:]
+                    if self.lazy:
+                        raw[k] = v
+                    else:
+                        k, v = self._variable_decoder(k, v)
+                        state[k] = v
+                variable = [line.strip()[3:]]
+                # blank lines separate states, only variable lines are projected
+                if line[0] == '/' and not self._is_projected(variable[0].split('=')[0].rstrip()):
+                    variable = None  # skip the lines of the variable
+                    skipped = True
                 lines.append(line)
             else:
-                variable += " " + line.strip()
+                if variable is not None:
+                    variable.append(line.strip())
                 lines.append(line)
 
-        f.close()
-
 
-    def trace_reader(self, file):
-        for state, _ in self.trace_reader_with_state_str(file):
+    # (kind, start, end, is_terminated, pattern) of a memory-mapped trace file:
+    # the states are in m[start:end] (followed by an end message if
+    # is_terminated), pattern matches the line starts they can be split at
+    def _get_mapped_range(self, m):
+        starting_chars = m[:2]
+        if starting_chars == b'--':
+            return 'trace', 0, len(m), False, re.compile(rb'^STATE_', re.M)
+        if starting_chars == b'st':
+            return 'dot', 0, len(m), False, re.compile(rb'^', re.M)
+        if starting_chars != b'@!':
+            return None
+        # the same as get_out_converted_string
+        m.seek(2)
+        start_msg = self.OUT_START_MSG.encode()
+        for line in iter(m.readline, b''):
+            if b'TLC Server' in line:
+                continue
+            if line[:1] != b'@':
+                start_msg = b'Error: ' + start_msg
+            break
+        for line in iter(m.readline, b''):
+            if line.startswith(start_msg):
+                break
+        else:
+            return None
+        start = m.tell()
+        end = re.compile(rb'^(?:' + b'|'.join(
+            re.escape(i.encode()) for i in self.OUT_END_MSGS) + rb')', re.M).search(m, start)
+        return ('out', start, end.start() if end else len(m), end is not None,
+                re.compile(rb'^(?:State|\d)', re.M))
+
+
+    # read states of m[start:end] (of a chunk of a trace file)
+    def _read_chunk(self, filename, kind, start, end, is_terminated, cur_action_line):
+        with open(filename, 'rb') as fb:
+            with mmap.mmap(fb.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                f = io.TextIOWrapper(io.BytesIO(m[start:end]))
+        if kind == 'out':
+            f = self.get_out_trace_string(f)
+        elif kind == 'dot':
+            f = self.get_dot_converted_string(f)
+        if is_terminated:  # the last state of the chunk ends here
+            f = chain(f, ['=' * 49 + '\n'])
+        return list(self._read_states(f, kind == 'dot', cur_action_line))
+
+
+    # read a large trace, MC.out or dot file with nproc processes: the file is
+    # memory-mapped and split at state boundaries into chunks of chunk_size
+    # bytes, states are yielded in the order of the file (lazy is ignored)
+    def parallel_trace_reader_with_state_str(self, file, nproc=None,
+                                             chunk_size=1 << 24):
+        with open(file, 'rb') as fb:
+            if os.fstat(fb.fileno()).st_size <= chunk_size:
+                lazy, self.lazy = self.lazy, False
+                try:
+                    yield from self.trace_reader_with_state_str(file)
+                finally:
+                    self.lazy = lazy
+                return
+            with mmap.mmap(fb.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                mapped_range = self._get_mapped_range(m)
+                if mapped_range is None:
+                    return
+                kind, start, end, is_terminated, split_pat = mapped_range
+                chunks = []
+                cur_action_line = None
+                while start < end:
+                    split = split_pat.search(m, min(start + chunk_size, end), end)
+                    split = split.start() if split and split.start() > start else end
+                    chunks.append((file, kind, start, split, is_terminated or split < end, cur_action_line))
+                    # the last action line of this chunk is used by the next one
+                    action_start = m.rfind(b'\n\\*', start, split)
+                    if kind == 'trace' and action_start >= 0:
+                        action_end = m.find(b'\n', action_start + 1, split)
+                        cur_action_line = m[action_start + 1:action_end + 1].decode()
+                    start = split
+
+        global _chunk_reader
+        _chunk_reader = self
+        lazy, self.lazy = self.lazy, False
+        try:
+            # forked workers inherit the reader with its handlers
+            nproc = nproc or cpu_count()
+            with get_context('fork').Pool(nproc) as pool:
+                # at most 2 * nproc chunks in flight, a slow consumer doesn't pile up parsed chunks
+                chunks = iter(chunks)
+                pending = deque(pool.apply_async(_read_chunk, (i,)) for i in islice(chunks, 2 * nproc))
+                while pending:
+                    states = pending.popleft().get()
+                    for chunk in islice(chunks, 1):
+                        pending.append(pool.apply_async(_read_chunk, (chunk,)))
+                    yield from states
+        finally:
+            self.lazy = lazy
+            _chunk_reader = None
+
+
+    def trace_reader(self, file, nproc=1):
+        if nproc == 1 or hasattr(file, 'read'):
+            states = self.trace_reader_with_state_str(file)
+        else:
+            states = self.parallel_trace_reader_with_state_str(file, nproc)
+        for state, _ in states:
             yield state
 
 
+_chunk_reader = None
+
+
+def _read_chunk(chunk):
+    return _chunk_reader._read_chunk(*chunk)
+
+
 get_dot_label_string = TraceReader.get_dot_label_string
 get_out_converted_string = TraceReader.get_out_converted_string
 get_dot_converted_string = TraceReader.get_dot_converted_string
@@ -360,7 +620,7 @@ if __name__ == '__main__':
     parser.add_argument(dest='trace_file', action='store',
                         help='TLA trace file')
     parser.add_argument('-o', dest='json_file', action='store', required=False,
-                        help="output to json file")
+                        help="output to json file (gzip compressed if it ends with .gz)")
     parser.add_argument('-i', dest='indent', action='store', required=False,
                         type=int, help="json file indent")
     parser.add_argument('-p', dest='handler', action='store', required=False,
@@ -376,25 +636,57 @@ if __name__ == '__main__':
                         help="sort dict by keys, true if -d is defined")
     parser.add_argument('-g', dest='graph', action='store_true', required=False,
                         help="get dot file graph")
+    parser.add_argument('-l', dest='json_lines', action='store_true',
+                        required=False,
+                        help="output json lines (a state per line) while reading")
+    parser.add_argument('-j', dest='nproc', action='store', type=int,
+                        default=1, required=False,
+                        help="parse a large file with n processes")
+    parser.add_argument('-v', dest='include', action='store', required=False,
+                        help="keep only these variables (comma separated)")
+    parser.add_argument('-x', dest='exclude', action='store', required=False,
+                        help="skip these variables (comma separated)")
     args = parser.parse_args()
 
     tr = TraceReader(save_action_name=args.action, hashable=args.hash_data,
-                     sort_dict=args.sort_keys, handler_py=args.handler)
+                     sort_dict=args.sort_keys, handler_py=args.handler,
+                     include=args.include and args.include.split(','),
+                     exclude=args.exclude and args.exclude.split(','))
 
-    if not args.graph:
-        states = list(tr.trace_reader(args.trace_file))
-    else:
-        states = tr.get_dot_graph(args.trace_file)
-    
     def serialize_sets(obj):
         if isinstance(obj, frozenset):
             return tuple(obj)
         return obj
     
 
-    if args.json_file:
-        with open(args.json_file, 'w') as f:
-            json.dump(states, f, indent=args.indent, default=serialize_sets)
-            f.write('\n')
+    # "-o file.gz" is gzip compressed
+    def open_json_file(filename):
+        if filename.endswith('.gz'):
+            import gzip
+            return gzip.open(filename, 'wt')
+        return open(filename, 'w')
+
+
+    if args.json_lines:
+        # write states one per line while reading them
+        if not args.graph:
+            states = tr.trace_reader(args.trace_file, args.nproc)
+        else:
+            states = tr.get_dot_graph(args.trace_file).items()
+        f = open_json_file(args.json_file) if args.json_file else sys.stdout
+        for state in states:
+            f.write(json.dumps(state, default=serialize_sets) + '\n')
+        if f is not sys.stdout:
+            f.close()
     else:
-        print(json.dumps(states, indent=args.indent, default=serialize_sets))
+        if not args.graph:
+            states = list(tr.trace_reader(args.trace_file, args.nproc))
+        else:
+            states = tr.get_dot_graph(args.trace_file)
+
+        if args.json_file:
+            with open_json_file(args.json_file) as f:
+                json.dump(states, f, indent=args.indent, default=serialize_sets)
+                f.write('\n')
+        else:
+            print(json.dumps(states, indent=args.indent, default=serialize_sets))